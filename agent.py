@@ -1,4 +1,7 @@
 from utils import elicit_input
+import metrics
+import tracing
+from asynchronous import Return, run, sleep, in_thread, call, call_budgeted
 
 class Agent(object):
 
@@ -40,7 +43,8 @@ class StatelessAgent(Agent):
     def act(self, obs):
         observations, actions = self.observations, self.actions
         observations += (obs,)
-        action = self.policy(observations, actions)
+        with metrics.timed("StatelessAgent.act"):
+            action = self.policy(observations, actions)
         actions += (action,)
         return action, StatelessAgent(self.policy, observations, actions)
 
@@ -49,11 +53,54 @@ class StatelessAgent(Agent):
 
 Human = StatelessAgent(elicit_input)
 
+class AsyncAgent(Agent):
+    """
+    An Agent that is implemented by the coroutine async_act.
+    Calling act runs async_act on an EventLoop of its own.
+    """
+
+    def async_act(self, obs):
+        raise NotImplementedError("AsyncAgents must define async_act")
+
+    def act(self, obs):
+        return run(self.async_act(obs))
+
+class Threaded(AsyncAgent):
+    """
+    Runs a blocking Agent (such as Human) on another thread,
+    so that waiting for it doesn't hold up other coroutines.
+    """
+
+    def __init__(self, agent):
+        self.agent = agent
+
+    def async_act(self, obs):
+        action, agent = yield in_thread(self.agent.act, obs)
+        raise Return((action, Threaded(agent)))
+
+class Delayed(AsyncAgent):
+    """
+    Behaves like agent, but takes latency seconds to respond without blocking other coroutines;
+    a stand-in for a slow overseer such as a human or a remote model.
+    """
+
+    def __init__(self, agent, latency):
+        self.agent = agent
+        self.latency = latency
+
+    def async_act(self, obs):
+        yield sleep(self.latency)
+        action, agent = yield call(self.agent, obs)
+        raise Return((action, Delayed(agent, self.latency)))
+
 class BudgetedAgent(object):
     """
     Like an Agent, but tracks resource constraints.
     """
 
+    #so that subclasses can do without a __dict__ by defining __slots__ of their own
+    __slots__ = ()
+
     def act(self, obs, budget):
         """
         returns (action, state of Agent after computing action, remaining budget)
@@ -78,5 +125,11 @@ class Budgeter(Agent):
         )
 
     def act(self, obs):
-        action, A, _ = self.A.act(obs, self.budget)
+        with tracing.span("budgeter", budget=self.budget) as span:
+            action, A, remaining = self.A.act(obs, self.budget)
+            span.set(spent=self.budget - remaining)
         return action, Budgeter(A, self.budget)
+
+    def async_act(self, obs):
+        action, A, _ = yield call_budgeted(self.A, obs, self.budget)
+        raise Return((action, Budgeter(A, self.budget)))
@@ -1,6 +1,12 @@
+import json
+import os
+import threading
+import time
+import weakref
+from utils import interleave
 from capabilities import PowerfulAgent
 from amplify import amplify, stateless_amplify
-from memoizer import Memoizer
+from memoizer import Memoizer, SQLiteCache
 
 #FIXME: Prevent catastrophic failure on adversarial inputs. Adversarial training?
 
@@ -16,18 +22,138 @@ from memoizer import Memoizer
 #appropriately handles the agent's uncertainty about the overseer's rating
 #(perhaps compare to a fixed basket to measure strength of preference?)
 
-def make_ALBA(distill, amplify):
+def make_ALBA(distill, amplify, directory=None, checkpoint_interval=60):
     """
     distill: takes as input an expensive agent,
     uses it to train a cheap learning agent
     amplify: takes as input a weak agent and a human,
     uses it to produce a slow but powerful agent
+    directory: if given, each level is checkpointed there (see Tower),
+    and distill is also passed the path where that level should keep its state
+    checkpoint_interval: with a directory, the number of seconds between checkpoints, or None
+
+    The levels built for each H are remembered for as long as ALBA is, so ALBA(H, n+1) reuses the n levels below it.
+    ALBA.close() takes a last checkpoint of every tower and stops checkpointing them in the background.
     """
+    #each Tower refers to its H, as do its levels, so the towers are kept for as long as ALBA is
+    towers = {}
+    lock = threading.Lock()
     def ALBA(H, n):
-        overseer = H if n == 0 else amplify(ALBA(H, n-1), H, n)
-        return distill(overseer, n)
+        with lock:
+            if H not in towers:
+                towers[H] = Tower(distill, amplify, H, directory, checkpoint_interval)
+            tower = towers[H]
+        return tower.level(n)
+    def close():
+        with lock:
+            closing = list(towers.values())
+        for tower in closing:
+            tower.close()
+    ALBA.towers = towers
+    ALBA.close = close
     return ALBA
 
+class Tower(object):
+    """
+    The levels of ALBA built on top of the overseer H, built bottom-up and remembered.
+
+    If directory is given, level k keeps its state under directory/level-k,
+    e.g. a Memoizer's cache or a learner's parameters,
+    and directory/manifest.json records the levels that have been built.
+    A new process pointed at the same directory picks up each level's state from disk,
+    so the tower resumes at the first level that was never built.
+
+    The tower is checkpointed whenever a level is built, and every checkpoint_interval seconds after that
+    (from a background thread, until close is called or the tower is collected),
+    so a crash loses at most that much of what the levels learn.
+    Levels whose state is written as they learn, like a Memoizer backed by a SQLiteCache, lose nothing.
+    """
+
+    def __init__(self, distill, amplify, H, directory=None, checkpoint_interval=None):
+        self.distill = distill
+        self.amplify = amplify
+        self.H = H
+        self.directory = directory
+        self.levels = []
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.manifest = {"levels": []}
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path) as f:
+                    self.manifest = json.load(f)
+        #the number of levels that earlier processes built
+        self.previously_built = len(self.manifest["levels"])
+        if directory is not None and checkpoint_interval is not None:
+            #the thread only holds a weak reference, so that it stops once nothing else refers to the tower
+            thread = threading.Thread(target=checkpoint_periodically, args=(weakref.ref(self), checkpoint_interval, self.stopped))
+            thread.daemon = True
+            thread.start()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.directory, "manifest.json")
+
+    def path(self, n):
+        return os.path.join(self.directory, "level-{}".format(n))
+
+    def restored(self, n):
+        """
+        whether level n was built by an earlier process, so that its state is on disk
+        """
+        return n < self.previously_built
+
+    def level(self, n):
+        with self.lock:
+            while len(self.levels) <= n:
+                k = len(self.levels)
+                overseer = self.H if k == 0 else self.amplify(self.levels[k-1], self.H, k)
+                if self.directory is None:
+                    self.levels.append(self.distill(overseer, k))
+                else:
+                    self.levels.append(self.distill(overseer, k, self.path(k)))
+                    if k >= len(self.manifest["levels"]):
+                        self.manifest["levels"].append({
+                            "level": k,
+                            "path": self.path(k),
+                            "agent": type(self.levels[k]).__name__,
+                            "created": time.time(),
+                        })
+                        self.checkpoint()
+            return self.levels[n]
+
+    def checkpoint(self):
+        """
+        saves the state of every level built so far, and the manifest
+        """
+        with self.lock:
+            for agent in self.levels:
+                if hasattr(agent, "checkpoint"):
+                    agent.checkpoint()
+            if self.directory is not None:
+                #write the new manifest beside the old one, so that a crash never leaves a partial manifest
+                temporary = self.manifest_path + ".tmp"
+                with open(temporary, "w") as f:
+                    json.dump(self.manifest, f, indent=2, sort_keys=True)
+                os.rename(temporary, self.manifest_path)
+
+    def close(self):
+        """
+        stops checkpointing in the background, after a last checkpoint
+        """
+        self.stopped.set()
+        self.checkpoint()
+
+def checkpoint_periodically(tower_ref, interval, stopped):
+    while not stopped.wait(interval):
+        tower = tower_ref()
+        if tower is None:
+            return
+        tower.checkpoint()
+        del tower
+
 def distill(overseer, n):
     expert = overseer
     reward, info_reward = make_comparisons(overseer)
@@ -40,6 +166,18 @@ ALBA = make_ALBA(distill=distill, amplify=lambda A,H,n: amplify(A))
 #and defers to the overseer whenever it encounters a novel situation.
 memoizer_ALBA = make_ALBA(distill=lambda O,n: Memoizer(O), amplify=lambda A,H,n: stateless_amplify(A))
 
+def checkpointed_memoizer_ALBA(directory, checkpoint_interval=60):
+    """
+    Like memoizer_ALBA, but each level memorizes into a SQLite file of its own under directory,
+    so that a later process can pick up where this one left off
+    """
+    return make_ALBA(
+        distill=lambda O,n,path: Memoizer(O, cache=SQLiteCache(path + ".sqlite")),
+        amplify=lambda A,H,n: stateless_amplify(A),
+        directory=directory,
+        checkpoint_interval=checkpoint_interval
+    )
+
 #---reward functions
 
 #NOTE: this code isn't actually tested
@@ -80,22 +218,7 @@ def make_rewards(overseer):
     return reward, info_reward
 
 def make_comparisons(overseer):
-    def compare(tuple1, tuple2):
-        observations1, actions1, info1 = tuple1
-        observations2, actions2, info2 = tuple2
-        message = (
-            "Compare the following two transcripts, and output a score between -1 and +1; "
-            "a score of -1 indicates the first transcript is significantly better, +1 indicates that "
-            "the second transcript is significantly better. After each transcript will be some explanatory "
-            "information which might help you make a better decision."
-            "\n\nTranscript 1:\n\n{}\n\nExplanation 1:\n\n{}"
-            "\n\nTranscript 2:\n\n{}\n\nExplanation 2:\n\n{}\n\n".format(
-                make_transcript(observations1, actions1), info1,
-                make_transcript(observations2, actions2), info2
-            )
-        )
-        response, _ = overseer.act(message)
-        return str_to_reward(response)
+    compare = Comparisons(overseer).compare
 
     def compare_info(observations, actions, info1, info2):
         message = (
@@ -112,3 +235,139 @@ def make_comparisons(overseer):
         return str_to_reward(response)
 
     return compare, compare_info
+
+class Comparisons(object):
+    """
+    Asks the overseer to compare (observations, actions, info) tuples, remembering every answer.
+
+    Comparisons are antisymmetric, so once (a, b) has been compared,
+    (b, a) is answered as its negation, and a tuple compared with itself scores 0.
+
+    batch_size: the number of pairs that compare_many puts in a single query to the overseer
+    """
+
+    def __init__(self, overseer, batch_size=1):
+        self.overseer = overseer
+        self.batch_size = batch_size
+        self.scores = {}
+        self.lock = threading.Lock()
+        self.queries = 0
+
+    def key(self, trajectory):
+        observations, actions, info = trajectory
+        return (tuple(observations), tuple(actions), info)
+
+    def cached(self, a, b):
+        """
+        the remembered score of (a, b), or None
+        """
+        a, b = self.key(a), self.key(b)
+        if a == b:
+            return 0
+        with self.lock:
+            if (a, b) in self.scores:
+                return self.scores[(a, b)]
+            if (b, a) in self.scores:
+                return -self.scores[(b, a)]
+        return None
+
+    def remember(self, a, b, score):
+        with self.lock:
+            self.scores[(self.key(a), self.key(b))] = score
+
+    def compare(self, a, b):
+        return self.compare_many([(a, b)])[0]
+
+    def compare_many(self, pairs):
+        """
+        returns the score of each pair, asking the overseer about the new ones batch_size pairs at a time
+        """
+        new = []
+        seen = set()
+        for a, b in pairs:
+            key = frozenset([self.key(a), self.key(b)])
+            if self.cached(a, b) is None and key not in seen:
+                seen.add(key)
+                new.append((a, b))
+        for i in range(0, len(new), self.batch_size):
+            batch = new[i:i+self.batch_size]
+            for (a, b), score in zip(batch, self.ask(batch)):
+                self.remember(a, b, score)
+        return [self.cached(a, b) for a, b in pairs]
+
+    def ask(self, batch):
+        """
+        asks the overseer for the score of each pair in batch
+        """
+        with self.lock:
+            self.queries += 1
+        if len(batch) == 1:
+            (observations1, actions1, info1), (observations2, actions2, info2) = batch[0]
+            message = (
+                "Compare the following two transcripts, and output a score between -1 and +1; "
+                "a score of -1 indicates the first transcript is significantly better, +1 indicates that "
+                "the second transcript is significantly better. After each transcript will be some explanatory "
+                "information which might help you make a better decision."
+                "\n\nTranscript 1:\n\n{}\n\nExplanation 1:\n\n{}"
+                "\n\nTranscript 2:\n\n{}\n\nExplanation 2:\n\n{}\n\n".format(
+                    make_transcript(observations1, actions1), info1,
+                    make_transcript(observations2, actions2), info2
+                )
+            )
+            response, _ = self.overseer.act(message)
+            return [str_to_reward(response)]
+        message = (
+            "Compare each of the following {} pairs of transcripts, and output a score between -1 and +1 "
+            "for each pair, in order and separated by commas; "
+            "a score of -1 indicates the first transcript of the pair is significantly better, +1 indicates that "
+            "the second transcript is significantly better. After each transcript will be some explanatory "
+            "information which might help you make a better decision.".format(len(batch))
+        )
+        for i, ((observations1, actions1, info1), (observations2, actions2, info2)) in enumerate(batch):
+            message += (
+                "\n\nPair {0}, transcript 1:\n\n{1}\n\nPair {0}, explanation 1:\n\n{2}"
+                "\n\nPair {0}, transcript 2:\n\n{3}\n\nPair {0}, explanation 2:\n\n{4}".format(
+                    i + 1,
+                    make_transcript(observations1, actions1), info1,
+                    make_transcript(observations2, actions2), info2
+                )
+            )
+        response, _ = self.overseer.act(message + "\n\n")
+        try:
+            scores = [str_to_reward(score) for score in response.split(",")]
+        except ValueError:
+            scores = []
+        if len(scores) != len(batch):
+            #the answer couldn't be understood, so ask about the pairs one at a time
+            return [self.ask([pair])[0] for pair in batch]
+        return scores
+
+    def rank(self, trajectories):
+        """
+        returns trajectories sorted from best to worst, using O(n log n) comparisons.
+
+        This is a bottom-up merge sort in which all of the merges at each level advance together,
+        so that the comparisons they need next can be batched into the same queries.
+        """
+        runs = [[trajectory] for trajectory in trajectories]
+        while len(runs) > 1:
+            #each merge is [merged, left, right, next index into left, next index into right]
+            merges = [[[], left, right, 0, 0] for left, right in zip(runs[0::2], runs[1::2])]
+            active = merges
+            while active:
+                scores = self.compare_many([(left[i], right[j]) for _, left, right, i, j in active])
+                for merge, score in zip(active, scores):
+                    merged, left, right, i, j = merge
+                    #a score above 0 means the second trajectory is better; ties keep their order
+                    if score > 0:
+                        merged.append(right[j])
+                        merge[4] += 1
+                    else:
+                        merged.append(left[i])
+                        merge[3] += 1
+                active = [merge for merge in active if merge[3] < len(merge[1]) and merge[4] < len(merge[2])]
+            merged_runs = [merged + left[i:] + right[j:] for merged, left, right, i, j in merges]
+            if len(runs) % 2 == 1:
+                merged_runs.append(runs[-1])
+            runs = merged_runs
+        return runs[0] if runs else []
@@ -1,5 +1,5 @@
 from hch import HCH
-from meta import Meta, StatelessMeta
+from meta import Meta, StatelessMeta, Encoding, ChunkedEncoding
 from reliability import amplify_reliability
 
 hch_budget = int(1e8)
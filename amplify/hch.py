@@ -1,21 +1,68 @@
+import time
+from collections import OrderedDict
 import pyparsing as pp
-from utils import unweave, areinstances
+import metrics
+import tracing
+from utils import unweave, areinstances, parallel_map, lru_cache, PersistentVector, WorkerPool
 from agent import Agent, Budgeter, BudgetedAgent
-from amplify.message import Message, Pointer, Channel, Referent, addressed_message
+import asynchronous
+from asynchronous import immediately, call, call_budgeted
+from amplify.message import Message, Pointer, Channel, Referent, Scope, ReleasedChannel, addressed_message, agent_hash, digest, reachable_channels
 
-def HCH(H, n=int(1e8)):
-    return Budgeter(BudgetedHCH(H), n)
+def HCH(H, n=int(1e8), workers=1, release=None, cache=None):
+    return Budgeter(BudgetedHCH(H, workers=workers, release=release, cache=cache), n)
 
 class BudgetedHCH(BudgetedAgent):
     """
     HCH transforms an Agent that operates on text
     into a better-resourced BudgetedAgent that operates on messages.
     The total bandwidth of HCH(H) is limited by the bandwidth of H.
+
+    workers: the number of subquestions that may be asked at once, by all of the ask* commands in the tree together;
+    if this is more than 1 then H must be safe to call from several threads.
+    The tree and its successors share one WorkerPool, whose threads are reused from command to command.
+
+    args: the Referents that H has seen so far, which its messages may point to;
+    each step extends a PersistentVector, so long workspaces aren't copied at every step
+
+    async_act runs the same computation as a coroutine;
+    then ask* runs all of its subquestions concurrently, and workers is ignored.
+
+    release: when to free the sub-agents that H can point to with @n, see amplify.message.Scope.
+    If None, they live as long as anything points to them.
+    If "turn", they are released when the top-level act returns,
+    so a long conversation doesn't keep every tree it has built alive;
+    afterwards @n pointers to them get the reply "that agent has been released".
+    If "reply", each agent's sub-agents are released when it replies,
+    so only the agents on the path to the current question are kept alive;
+    an agent can then be asked follow-up questions, but its own sub-agents are gone.
+    Either way, the agents that the reply points to, and those they can point to in turn, are kept,
+    so the reply (or e.g. Meta's state) can be used in a later turn.
+
+    scope: the Scope that the Channels made by this agent belong to
+
+    cache: a MemoryCache (e.g. memoizer.LRUCache()) in which to remember the reply to each subquestion, or None.
+    A question asked again of the same agent, with the same budget, is answered from the cache,
+    wherever it is asked in the tree, and identical questions in one ask* are asked once.
+    The key ignores who is asking, so a reply that points back to its asker points to the first one to ask.
+    A remembered reply costs what it cost the first time, so the budget is spent as it would be without the cache.
+    With release set, a reply is only reused within the Scope it was computed in.
+    Identical questions asked at the same time from different ask*s may both be asked.
     """
 
-    def __init__(self, H, child_base=None, args=()):
+    #a tree keeps many states alive, so they don't each carry a __dict__
+    __slots__ = ("H", "args", "workers", "release", "scope", "cache", "child_base", "__weakref__")
+
+    def __init__(self, H, child_base=None, args=(), workers=1, release=None, scope=None, cache=None):
         self.H = H
-        self.args = args 
+        if not isinstance(args, PersistentVector):
+            assert areinstances(tuple(args), Referent)
+            args = PersistentVector(args)
+        self.args = args
+        self.workers = workers if isinstance(workers, WorkerPool) else WorkerPool(workers)
+        self.release = release
+        self.scope = scope
+        self.cache = cache
         #by default, children are copies of self
         self.child_base = self if child_base is None else child_base
         assert self.well_formed()
@@ -27,27 +74,113 @@ class BudgetedHCH(BudgetedAgent):
         return (
             isinstance(self.H, Agent) and
             isinstance(self.child_base, BudgetedHCH) and
-            areinstances(self.args, Referent)
+            #the elements come from well-formed Messages, so they are Referents
+            isinstance(self.args, PersistentVector) and
+            self.release in (None, "turn", "reply")
         )
 
+    def in_scope(self, scope):
+        return BudgetedHCH(self.H, self.child_base, self.args, self.workers, self.release, scope, self.cache)
+
+    def open_scope(self):
+        """
+        returns a new Scope for this act's Channels, or None if they belong to self.scope
+        """
+        if self.release == "reply" or (self.release == "turn" and (self.scope is None or self.scope.released)):
+            return Scope()
+        return None
+
+    def close_scope(self, scope, result):
+        #the Channels that the reply can reach stay usable, so they can be passed on and asked follow-up questions
+        scope.release(() if result is None else reachable_channels([result[0]]))
+        metrics.increment("BudgetedHCH.scopes_released")
+
+    def referents(self):
+        """
+        the Referents that this agent can point to, see amplify.message.reachable_channels
+        """
+        return self.args
+
     def act(self, obs, budget):
-        state = self
-        while True:
-            message = state.view_message(obs)
-            if budget < 0:
-                raise Exception("It really shouldn't be possible to get to < 0 budget.")
-            elif budget == 0:
-                message += "\n[You have no budget, type a message to reply]"
-            else:
-                message += "\n[Remaining budget is {}]".format(budget)
-            response, new_H = state.H.act(message)
-            state = BudgetedHCH(new_H, state.child_base, state.args + obs.args)
-            if budget <= 0:
-                return parse_message(response), state, 0
-            command = parse_command(response)
-            obs, done, return_value, spending = command.execute(state, budget)
-            budget -= spending
-            if done: return return_value, state, budget
+        scope = self.open_scope()
+        if scope is None:
+            return self.run(obs, budget)
+        result = None
+        try:
+            result = self.in_scope(scope).run(obs, budget)
+            return result
+        finally:
+            self.close_scope(scope, result)
+
+    def run(self, obs, budget):
+        with metrics.timed("BudgetedHCH.act"), tracing.span("hch", budget=budget) as span:
+            if span.recording:
+                span.set(question=self.view_message(obs)[:80])
+            initial_budget = budget
+            state = self
+            while True:
+                start = time.time()
+                response, new_H = state.H.act(state.prompt(obs, budget))
+                parsed = time.time()
+                span.add("overseer_seconds", parsed - start)
+                state = state.successor(new_H, obs)
+                if budget <= 0:
+                    result = parse_message(response), state, 0
+                    span.add("parse_seconds", time.time() - parsed)
+                    break
+                command = parse_command(response)
+                span.add("parse_seconds", time.time() - parsed)
+                span.append("commands", type(command).__name__)
+                metrics.increment("BudgetedHCH.commands.{}".format(type(command).__name__))
+                obs, done, return_value, spending = command.execute(state, budget)
+                budget -= spending
+                if done:
+                    result = return_value, state, budget
+                    break
+            span.set(spent=initial_budget - result[2], refunded=result[2])
+            return result
+
+    def async_act(self, obs, budget):
+        scope = self.open_scope()
+        if scope is None:
+            result = yield self.async_run(obs, budget)
+            raise asynchronous.Return(result)
+        result = None
+        try:
+            result = yield self.in_scope(scope).async_run(obs, budget)
+        finally:
+            self.close_scope(scope, result)
+        raise asynchronous.Return(result)
+
+    def async_run(self, obs, budget):
+        with metrics.timed("BudgetedHCH.act"):
+            state = self
+            while True:
+                response, new_H = yield call(state.H, state.prompt(obs, budget))
+                state = state.successor(new_H, obs)
+                if budget <= 0:
+                    raise asynchronous.Return((parse_message(response), state, 0))
+                command = parse_command(response)
+                metrics.increment("BudgetedHCH.commands.{}".format(type(command).__name__))
+                obs, done, return_value, spending = yield command.async_execute(state, budget)
+                budget -= spending
+                if done: raise asynchronous.Return((return_value, state, budget))
+
+    def prompt(self, obs, budget):
+        message = self.view_message(obs)
+        if budget < 0:
+            raise Exception("It really shouldn't be possible to get to < 0 budget.")
+        elif budget == 0:
+            message += "\n[You have no budget, type a message to reply]"
+        else:
+            message += "\n[Remaining budget is {}]".format(budget)
+        return message
+
+    def successor(self, H, obs):
+        """
+        the state after H has seen obs
+        """
+        return BudgetedHCH(H, self.child_base, self.args.extend(obs.args), self.workers, self.release, self.scope, self.cache)
 
     def view_message(self, message):
         n = len(self.args)
@@ -61,6 +194,9 @@ class Command(object):
     def execute(self, env):
         raise NotImplemented()
 
+    def async_execute(self, env, budget):
+        return immediately(self.execute(env, budget))
+
 class Ask(Command):
 
     def __init__(self, message, budget=None, recipient=None):
@@ -68,17 +204,120 @@ class Ask(Command):
         self.recipient_channel = recipient
         self.budget = budget
 
-    def execute(self, env, budget):
+    def prepare(self, env, budget):
+        """
+        returns the recipient, the message to send it, the budget to give it,
+        and the key of its reply in env.cache (None if there is no cache)
+        """
         default_budget = budget / 10
         max_budget = budget - 1
         sub_budget = min(max_budget, self.budget if self.budget is not None else default_budget)
-        message = addressed_message(env, self.message.instantiate(env.args))
+        question = self.message.instantiate(env.args)
+        message = addressed_message(env, question, env.scope)
         if self.recipient_channel is None:
             recipient = env.child()
         else:
             recipient = self.recipient_channel.instantiate(env.args).agent
-        response, recipient, remaining = recipient.act(message, sub_budget)
-        return addressed_message(recipient, response), False, None, sub_budget-remaining + 1
+        key = None if env.cache is None else self.key(env, recipient, question, sub_budget)
+        if env.release is not None:
+            #the recipient's Channels belong to the asker's scope, unless it opens one of its own
+            recipient = recipient.in_scope(env.scope)
+        return recipient, message, sub_budget, key
+
+    def key(self, env, recipient, question, sub_budget):
+        #the message sent also points to the asker, which is left out so that different askers share replies
+        scope = "" if env.release is None else str(env.scope.id)
+        return digest("ask", agent_hash(recipient), question.content_hash, str(sub_budget), scope)
+
+    def execute(self, env, budget):
+        try:
+            recipient, message, sub_budget, key = self.prepare(env, budget)
+        except ReleasedChannel:
+            return released_reply, False, None, 1
+        metrics.increment("BudgetedHCH.asks")
+        entry = None if key is None else env.cache.lookup(key)
+        if entry is None:
+            with tracing.span("ask", budget=sub_budget, child=self.recipient_channel is None) as span:
+                entry = recipient.act(message, sub_budget)
+                span.set(spent=sub_budget-entry[2], refunded=entry[2])
+            if key is not None:
+                metrics.increment("BudgetedHCH.ask_misses")
+                env.cache.save(key, entry)
+        else:
+            metrics.increment("BudgetedHCH.ask_hits")
+        return self.result(env, sub_budget, entry)
+
+    def async_execute(self, env, budget):
+        try:
+            recipient, message, sub_budget, key = self.prepare(env, budget)
+        except ReleasedChannel:
+            raise asynchronous.Return((released_reply, False, None, 1))
+        metrics.increment("BudgetedHCH.asks")
+        entry = None if key is None else env.cache.lookup(key)
+        if entry is None:
+            entry = yield call_budgeted(recipient, message, sub_budget)
+            if key is not None:
+                metrics.increment("BudgetedHCH.ask_misses")
+                env.cache.save(key, entry)
+        else:
+            metrics.increment("BudgetedHCH.ask_hits")
+        raise asynchronous.Return(self.result(env, sub_budget, entry))
+
+    def result(self, env, sub_budget, entry):
+        response, recipient, remaining = entry
+        return addressed_message(recipient, response, env.scope), False, None, sub_budget-remaining + 1
+
+released_reply = Message("that agent has been released")
+
+class AskAll(Command):
+    """
+    Asks several questions at once, splitting the budget evenly between them,
+    and replies with a message pointing to each of the answers in turn
+    """
+
+    def __init__(self, messages, budget=None, recipient=None):
+        self.messages = messages
+        self.recipient_channel = recipient
+        self.budget = budget
+
+    def questions(self, budget):
+        default_budget = budget / 10
+        max_budget = budget - 1
+        sub_budget = min(max_budget, self.budget if self.budget is not None else default_budget) / len(self.messages)
+        return [Ask(message, sub_budget, self.recipient_channel) for message in self.messages]
+
+    def combine(self, results):
+        responses = [response for response, _, _, _ in results]
+        #the ask* command is charged once, rather than once per question
+        spending = sum(spent - 1 for _, _, _, spent in results) + 1
+        reply = Message("the replies are {}".format(", ".join(["[]"] * len(responses))), *responses)
+        return reply, False, None, spending
+
+    def distinct(self, env, asks):
+        """
+        the asks to run; with a cache, a question that appears more than once is only asked once
+        """
+        if env.cache is None:
+            return asks
+        return list(OrderedDict((ask.message, ask) for ask in asks).values())
+
+    def expand(self, asks, distinct, results):
+        if distinct is asks:
+            return results
+        by_message = dict(zip([ask.message for ask in distinct], results))
+        return [by_message[ask.message] for ask in asks]
+
+    def execute(self, env, budget):
+        asks = self.questions(budget)
+        distinct = self.distinct(env, asks)
+        results = parallel_map(lambda ask: ask.execute(env, budget), distinct, env.workers)
+        return self.combine(self.expand(asks, distinct, results))
+
+    def async_execute(self, env, budget):
+        asks = self.questions(budget)
+        distinct = self.distinct(env, asks)
+        results = yield [ask.async_execute(env, budget) for ask in distinct]
+        raise asynchronous.Return(self.combine(self.expand(asks, distinct, results)))
 
 class View(Command):
 
@@ -99,21 +338,25 @@ class Return(Command):
 class Reflect(Command):
 
     def execute(self, env, budget):
-        return Message("you are []", Channel(env)), False, None, 1
+        return Message("you are []", Channel(env, env.scope)), False, None, 1
 
 class MalformedCommand(Command):
 
     def execute(self, env, budget):
-        return Message("the valid commands are 'reply', 'ask', 'reflect', 'view', and 'ask@N'"), False, None, 1
+        return Message("the valid commands are 'reply', 'ask', 'ask*', 'reflect', 'view', and 'ask@N'"), False, None, 1
 
 #----parsing
 
+#Commands and Messages are immutable, so identical responses can share a parse
+
+@lru_cache(10000)
 def parse_command(s):
     try:
         return command.parseString(s, parseAll=True)[0]
     except pp.ParseException:
         return MalformedCommand()
 
+@lru_cache(10000)
 def parse_message(s):
     try:
         return message.parseString(s, parseAll=True)[0]
@@ -139,7 +382,11 @@ literal_message = (
         pp.Optional(prose, default="") +
         pp.ZeroOrMore(argument + pp.Optional(prose, default=""))
     ).setParseAction(lambda xs : Message(tuple(unweave(xs)[0]), *unweave(xs)[1]))
-message << (message_referent ^ literal_message)
+#A message that is nothing but a pointer is parsed as the pointer itself.
+#This matches (message_referent ^ literal_message), but the longest-match ^ would parse
+#every submessage twice, taking time exponential in how deeply submessages are nested.
+message_end = pp.FollowedBy(pp.Regex(r"([\t\n\r]\s*)?(\)|\Z)")).leaveWhitespace()
+message << ((message_referent + message_end) | literal_message)
 
 target_modifier = raw("@")+number
 target_modifier.setParseAction(lambda xs : ("recipient", Pointer(xs[0], type=Channel)))
@@ -153,6 +400,9 @@ ask_modifiers.setParseAction(lambda xs : dict(list(xs)))
 ask_command = (raw("ask")) + ask_modifiers + message
 ask_command.setParseAction(lambda xs : Ask(xs[1], **xs[0]))
 
+ask_all_command = raw("ask*") + ask_modifiers + pp.OneOrMore(submessage)
+ask_all_command.setParseAction(lambda xs : AskAll(tuple(xs[1:]), **xs[0]))
+
 reply_command = (raw("reply") | raw("return")) + message
 reply_command.setParseAction(lambda xs : Return(xs[0]))
 
@@ -162,4 +412,4 @@ reflect_command.setParseAction(lambda xs : Reflect())
 view_command = raw("view") + message
 view_command.setParseAction(lambda xs : View(xs[0]))
 
-command = ask_command | reply_command | reflect_command | view_command
+command = ask_all_command | ask_command | reply_command | reflect_command | view_command
@@ -1,31 +1,92 @@
 from utils import areinstances, interleave, unweave
+import hashlib
+import itertools
+import threading
+import uuid
+import weakref
 import six
 
+def digest(*parts):
+    """
+    hashes a sequence of strings;
+    each part is prefixed with its length, so that different sequences are hashed differently
+    """
+    h = hashlib.md5()
+    for part in parts:
+        if isinstance(part, six.text_type):
+            part = part.encode("utf-8")
+        h.update("{}:".format(len(part)).encode("ascii"))
+        h.update(part)
+    return h.hexdigest()
+
+#Messages, Pointers and Channels are interned: constructing one that already exists
+#returns the existing object, so equal Referents are identical and compare with `is`.
+#The tables hold their Referents weakly, and the lock keeps threads from interning duplicates.
+intern_lock = threading.Lock()
+
+def intern(table, key, make):
+    result = table.get(key)
+    if result is not None:
+        return result
+    with intern_lock:
+        result = table.get(key)
+        if result is None:
+            result = make()
+            table[key] = result
+        return result
+
 class Referent(object):
     """
     A Referent is anything that can be referred to in a message,
     including Messages, Pointers, and Channels
     """
 
+    __slots__ = ()
+
     symbol = "?"
 
     def instantiate(self, xs):
         raise NotImplemented()
 
+    @property
+    def content_hash(self):
+        """
+        a hash of the structure of this Referent, computed once and then cached
+        """
+        if getattr(self, "_content_hash", None) is None:
+            self._content_hash = self.compute_hash()
+        return self._content_hash
+
+    def compute_hash(self):
+        raise Exception("unhashable referent {}".format(type(self)))
+
 class Message(Referent):
     """
-    A Message consists of text interspersed with Referents
+    A Message consists of text interspersed with Referents.
+
+    Messages are immutable and interned, so identical subtrees are shared
+    and two Messages are equal exactly when they are the same object.
     """
 
+    __slots__ = ("text", "args", "_content_hash", "__weakref__")
+
     symbol = "#"
 
-    def __init__(self, text, *args):
+    #maps (text, args) to the Message with that text and those args
+    interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, text, *args):
         if isinstance(text, six.string_types):
             text = tuple(text.split("[]"))
-        args = tuple(args)
-        self.text = text
-        self.args = args 
-        assert self.well_formed()
+        else:
+            text = tuple(text)
+        def make():
+            self = super(Message, cls).__new__(cls)
+            self.text = text
+            self.args = args
+            assert self.well_formed()
+            return self
+        return intern(Message.interned, (text, args), make)
 
     def well_formed(self):
         return (
@@ -51,34 +112,189 @@ class Message(Referent):
     def __str__(self):
         return self.format(['({})'.format(arg) for arg in self.args])
 
-    def __eq__(self, other):
-        return self.text == other.text and self.args == other.args
-
-    def __ne__(self, other):
-        return self.text != other.text or self.args != other.args
+    #equality and hashing are inherited from object, and go by identity
 
     def instantiate(self, xs):
         return Message(self.text, *[arg.instantiate(xs) for arg in self.args])
 
+    def compute_hash(self):
+        return digest("message", *(self.text + tuple(arg.content_hash for arg in self.args)))
+
+class ReleasedChannel(Exception):
+    """
+    Raised when a Channel is used after its Scope has been released
+    """
+
+class ChannelRegistry(object):
+    """
+    Maps the handle of each live Channel to the agent it wraps.
+
+    An entry lasts until its Channel is deleted or its Scope is released,
+    so the registry is what keeps agents alive, and releasing a Scope frees the agents
+    that only its Channels could reach, even if messages still point to the Channels.
+    """
+
+    #next() on a count, and setting or popping a dict entry, are each atomic,
+    #so the registry needs no lock (which a Channel deleted during garbage collection could deadlock on)
+
+    def __init__(self):
+        self.handles = itertools.count()
+        self.agents = {}
+
+    def register(self, agent):
+        handle = next(self.handles)
+        self.agents[handle] = agent
+        return handle
+
+    def resolve(self, handle):
+        try:
+            return self.agents[handle]
+        except KeyError:
+            raise ReleasedChannel("the agent behind this channel has been released")
+
+    def forget(self, handle):
+        self.agents.pop(handle, None)
+
+    def __len__(self):
+        return len(self.agents)
+
+registry = ChannelRegistry()
+
+class Scope(object):
+    """
+    A group of Channels that are released together.
+    Channels made outside of any Scope belong to root_scope, which is never released,
+    so their agents live exactly as long as they do.
+    """
+
+    ids = itertools.count()
+
+    def __init__(self):
+        self.id = next(Scope.ids)
+        self.lock = threading.Lock()
+        self.channels = weakref.WeakSet()
+        self.released = False
+
+    def add(self, channel):
+        if self is root_scope:
+            return
+        with self.lock:
+            if self.released:
+                raise ReleasedChannel("can't make a channel in a scope that has been released")
+            self.channels.add(channel)
+
+    def release(self, keep=()):
+        """
+        releases the agent behind each of this scope's Channels, other than those in keep;
+        using them afterwards raises ReleasedChannel
+
+        The Channels in keep stay usable for as long as they are referred to.
+        """
+        with self.lock:
+            self.released = True
+            channels = list(self.channels)
+        for channel in channels:
+            if channel not in keep:
+                channel.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+root_scope = Scope()
+
 class Channel(Referent):
     """
-    A Channel is a wrapper around an Agent, that lets it be pointed to in messages
+    A Channel is a wrapper around an Agent, that lets it be pointed to in messages.
+    There is one Channel per agent in each Scope.
+
+    The Channel holds a handle, which the registry maps to the agent until the Channel's Scope is released.
     """
 
+    __slots__ = ("handle", "key", "_content_hash", "__weakref__")
+
     symbol = "@"
 
-    def __init__(self, agent):
-        self.agent = agent
-        assert self.well_formed()
+    #maps (id(agent), id of scope) to the Channel wrapping agent in scope;
+    #the registry keeps agent alive until the entry is removed, so the id isn't reused
+    interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, agent, scope=None):
+        scope = root_scope if scope is None else scope
+        key = (id(agent), scope.id)
+        def make():
+            self = super(Channel, cls).__new__(cls)
+            self.handle = registry.register(agent)
+            self.key = key
+            assert self.well_formed()
+            scope.add(self)
+            return self
+        return intern(Channel.interned, key, make)
+
+    @property
+    def agent(self):
+        return registry.resolve(self.handle)
 
     def well_formed(self):
         return hasattr(self.agent, 'act')
 
+    def release(self):
+        #the hash depends on the agent, so it has to be computed while the agent is still around
+        try:
+            self.content_hash
+        except ReleasedChannel:
+            return
+        with intern_lock:
+            if Channel.interned.get(self.key) is self:
+                del Channel.interned[self.key]
+        registry.forget(self.handle)
+
+    #a Channel only refers to ints, so it is never part of a cycle, and is deleted as soon as it is unreachable
+    def __del__(self, forget=registry.forget):
+        forget(self.handle)
+
     def instantiate(self, xs):
         raise Exception("should not try to instantiate a channel")
 
-def addressed_message(sender, message):
-    return Message("[]: ", Channel(sender)) + message
+    def compute_hash(self):
+        return digest("channel", agent_hash(self.agent))
+
+#agents without a content_hash of their own are identified by a token
+#that is unique to the object, so two Channels agree only if they wrap the same agent
+agent_tokens = weakref.WeakKeyDictionary()
+
+def agent_hash(agent):
+    if hasattr(agent, "content_hash"):
+        return agent.content_hash
+    return agent_tokens.setdefault(agent, uuid.uuid4().hex)
+
+def reachable_channels(roots):
+    """
+    returns the set of Channels that can be reached from the Referents in roots,
+    through the arguments of Messages and the referents() of the agents behind Channels
+    """
+    seen = set()
+    stack = list(roots)
+    while stack:
+        x = stack.pop()
+        if x in seen:
+            continue
+        seen.add(x)
+        if isinstance(x, Message):
+            stack.extend(x.args)
+        elif isinstance(x, Channel):
+            try:
+                agent = x.agent
+            except ReleasedChannel:
+                continue
+            if hasattr(agent, "referents"):
+                stack.extend(agent.referents())
+    return set(x for x in seen if isinstance(x, Channel))
+
+def addressed_message(sender, message, scope=None):
+    return Message("[]: ", Channel(sender, scope)) + message
 
 class Pointer(Referent):
     """
@@ -86,11 +302,18 @@ class Pointer(Referent):
     which can be instantiated given a list of arguments
     """
 
+    __slots__ = ("n", "type", "_content_hash", "__weakref__")
+
+    interned = weakref.WeakValueDictionary()
 
-    def __init__(self, n, type=Referent):
-        self.n = n
-        self.type = type
-        #assert self.well_formed()
+    def __new__(cls, n, type=Referent):
+        def make():
+            self = super(Pointer, cls).__new__(cls)
+            self.n = n
+            self.type = type
+            #assert self.well_formed()
+            return self
+        return intern(Pointer.interned, (n, type), make)
 
     def well_formed(self):
         return (
@@ -107,5 +330,8 @@ class Pointer(Referent):
     def symbol(self):
         return "{}->".format(self.type.symbol)
 
+    def compute_hash(self):
+        return digest("pointer", self.type.__name__, str(self.n))
+
     def __str__(self):
         return "{}{}".format(self.symbol, self.n)
@@ -1,5 +1,10 @@
+import re
+import string
+import metrics
+import tracing
 from amplify.message import Message
 from agent import Agent, StatelessAgent
+from asynchronous import Query, Return, answer_async, answer_blocking, call
 
 class Meta(Agent):
     """
@@ -9,97 +14,256 @@ class Meta(Agent):
     The total bandwidth of Meta() is generally unlimited.
     """
 
-    def __init__(self, agent, state=None):
+    def __init__(self, agent, state=None, encoding=None):
         self.state = Message("the initial state of an agent") if state is None else state
         self.agent = agent
+        self.encoding = binary if encoding is None else encoding
 
     def act(self, obs):
-        obsm = encode_str(obs)
-        agent = self.agent
-        query = Message("what string should be returned by an agent in state [] who observes []?", self.state, obsm)
-        actionm, agent = agent.act(query)
-        state, agent = agent.act(Message("what should the agent's state be after responding?"))
-        return decode_str(actionm, self.agent), Meta(self.agent, state)
-
-def StatelessMeta(agent):
+        with metrics.timed("Meta.act"), tracing.span("meta", encoding=type(self.encoding).__name__, observation_chars=len(obs)) as span:
+            metrics.increment("Meta.encodes")
+            obsm = self.encoding.encode_str(obs)
+            agent = self.agent
+            query = Message("what string should be returned by an agent in state [] who observes []?", self.state, obsm)
+            actionm, agent = agent.act(query)
+            state, agent = agent.act(Message("what should the agent's state be after responding?"))
+            metrics.increment("Meta.decodes")
+            action = self.encoding.decode_str(actionm, self.agent)
+            span.set(action_chars=len(action))
+        return action, Meta(self.agent, state, self.encoding)
+
+    def async_act(self, obs):
+        with metrics.timed("Meta.act"):
+            metrics.increment("Meta.encodes")
+            obsm = self.encoding.encode_str(obs)
+            agent = self.agent
+            query = Message("what string should be returned by an agent in state [] who observes []?", self.state, obsm)
+            actionm, agent = yield call(agent, query)
+            state, agent = yield call(agent, Message("what should the agent's state be after responding?"))
+            metrics.increment("Meta.decodes")
+            action = yield self.encoding.async_decode_str(actionm, self.agent)
+            raise Return((action, Meta(self.agent, state, self.encoding)))
+
+def StatelessMeta(agent, encoding=None):
     """
     Like Meta, but without state
     """
-    return StatelessAgent(stateless_meta_policy(agent))
+    return StatelessAgent(stateless_meta_policy(agent, binary if encoding is None else encoding))
 
-def stateless_meta_policy(agent):
+def stateless_meta_policy(agent, encoding):
     def policy(observations, actions):
-        observationsm = encode_list([encode_str(obs) for obs in observations])
-        actionsm = encode_list([encode_str(act) for act in actions])
+        metrics.increment("Meta.encodes", len(observations) + len(actions))
+        observationsm = encoding.encode_list([encoding.encode_str(obs) for obs in observations])
+        actionsm = encoding.encode_list([encoding.encode_str(act) for act in actions])
         message = (
             "what string should an agent output after observing the sequence of observations [], "
             "given that their past responses have been []?"
         )
         query = Message(message, observationsm, actionsm)
         actionm, _ = agent.act(query)
-        return decode_str(actionm, agent)
+        metrics.increment("Meta.decodes")
+        return encoding.decode_str(actionm, agent)
     return policy
 
 
 #-----conversions between python objects and Messages
 
+#Each decoder first checks whether its argument was built by the matching encoder,
+#in which case it reads the answer straight off the Message;
+#the agent is only consulted about parts whose form isn't recognized.
+
+#Each decoder is written once, as a generator that yields a Query whenever it needs the agent's reply,
+#yields another decoder to receive its result, and returns by raising Return.
+#decode_str etc. answer each Query with agent.act, so a blocking agent is used exactly as Meta.act uses it,
+#while async_decode_str etc. are coroutines that answer it with call (see answer_blocking and answer_async).
+
+def has_form(x, form):
+    """
+    whether x is a Message built from the template form, e.g. has_form(x, "two times []")
+    """
+    return isinstance(x, Message) and x.text == tuple(form.split("[]"))
+
 def decode_str(x, H):
-    agent = H
-    char_list, agent = agent.act(Message("what is the list of characters in []?", x))
-    return "".join([decode_char(x, H) for x in decode_list(char_list, H)])
+    return answer_blocking(str_decoder(x, H))
+
+def async_decode_str(x, H):
+    return answer_async(str_decoder(x, H))
+
+def str_decoder(x, H):
+    if has_form(x, "the string with list of characters []"):
+        char_list = x.args[0]
+    else:
+        agent = H
+        char_list, agent = yield Query(agent, Message("what is the list of characters in []?", x))
+    chars = yield list_decoder(char_list, H)
+    result = []
+    for char in chars:
+        c = yield char_decoder(char, H)
+        result.append(c)
+    raise Return("".join(result))
 
 def encode_str(x):
     char_list = encode_list([encode_char(c) for c in x])
     return Message("the string with list of characters []", char_list)
 
 def decode_char(x, H):
-    agent = H
-    code, agent = agent.act(Message("what is the ASCII code of []?", x))
-    return chr(decode_int(code, H))
+    return answer_blocking(char_decoder(x, H))
+
+def async_decode_char(x, H):
+    return answer_async(char_decoder(x, H))
+
+def char_decoder(x, H):
+    if has_form(x, "the character with ASCII code []"):
+        code = x.args[0]
+    else:
+        agent = H
+        code, agent = yield Query(agent, Message("what is the ASCII code of []?", x))
+    n = yield int_decoder(code, H)
+    raise Return(chr(n))
 
 def encode_char(x):
     code = encode_int(ord(x))
     return Message("the character with ASCII code []", code)
 
+#lists are balanced binary trees, so that they can be encoded and decoded without deep recursion,
+#and so that an agent can find any element by descending through logarithmically many nodes
+
+concatenation_prefix = re.compile(r"^the list of (\d+) elements made of $")
+
+def is_concatenation(x):
+    return (
+        isinstance(x, Message) and
+        x.text[1:] == (" followed by ", "") and
+        concatenation_prefix.match(x.text[0]) is not None
+    )
+
 def decode_list(x, H):
-    agent = H
-    empty, agent = agent.act(Message("is [] empty? (respond yes/no)", x))
-    if empty == Message("yes"):
-        return []
-    elif empty == Message("no"):
-        x, agent = agent.act(Message("what is its first element?"))
-        xs, agent = agent.act(Message("what is the list of remaining elements?"))
-        return [x] + decode_list(xs, H)
-    else:
-        raise Exception("is empty is not 'yes' or 'no'")
+    return answer_blocking(list_decoder(x, H))
+
+def async_decode_list(x, H):
+    return answer_async(list_decoder(x, H))
+
+def list_decoder(x, H):
+    result = []
+    stack = [x]
+    while stack:
+        x = stack.pop()
+        if has_form(x, "the empty list"):
+            continue
+        elif has_form(x, "the list with the single element []"):
+            result.append(x.args[0])
+            continue
+        elif is_concatenation(x):
+            stack.append(x.args[1])
+            stack.append(x.args[0])
+            continue
+        agent = H
+        shape, agent = yield Query(agent, Message("is [] empty, a singleton, or a concatenation? (respond verbatim)", x))
+        if shape == Message("empty"):
+            continue
+        elif shape == Message("singleton"):
+            element, agent = yield Query(agent, Message("what is its element?"))
+            result.append(element)
+        elif shape == Message("concatenation"):
+            first, agent = yield Query(agent, Message("what is the first list?"))
+            second, agent = yield Query(agent, Message("what is the second list?"))
+            stack.append(second)
+            stack.append(first)
+        else:
+            raise Exception("shape is not 'empty', 'singleton', or 'concatenation'")
+    raise Return(result)
+
+def decode_list_element(x, i, H, int_encoder=None):
+    """
+    returns element i of the list x, without decoding the rest of the list
+    """
+    return answer_blocking(list_element_decoder(x, i, H, int_encoder))
+
+def async_decode_list_element(x, i, H, int_encoder=None):
+    return answer_async(list_element_decoder(x, i, H, int_encoder))
+
+def list_element_decoder(x, i, H, int_encoder=None):
+    #descend through the nodes built by encode_list, using the number of elements each one states
+    while True:
+        if has_form(x, "the list with the single element []") and i == 0:
+            raise Return(x.args[0])
+        if not is_concatenation(x):
+            break
+        n = list_length(x.args[0])
+        if n is None:
+            break
+        if i < n:
+            x = x.args[0]
+        else:
+            x, i = x.args[1], i - n
+    int_encoder = encode_int if int_encoder is None else int_encoder
+    element, _ = yield Query(H, Message("what is element [] of [] (counting from zero)?", int_encoder(i), x))
+    raise Return(element)
+
+def list_length(x):
+    """
+    the number of elements in x, if it was built by encode_list, or else None
+    """
+    if has_form(x, "the empty list"):
+        return 0
+    if has_form(x, "the list with the single element []"):
+        return 1
+    if is_concatenation(x):
+        return int(concatenation_prefix.match(x.text[0]).group(1))
+    return None
 
 def encode_list(x):
     if len(x) == 0:
         return Message("the empty list")
-    else:
-        return Message("the list with first element [] and remaining elements in the list []", x[0], encode_list(x[1:]))
+    nodes = [(1, Message("the list with the single element []", element)) for element in x]
+    while len(nodes) > 1:
+        paired = []
+        for (n, first), (m, second) in zip(nodes[0::2], nodes[1::2]):
+            paired.append((n+m, Message("the list of {} elements made of [] followed by []".format(n+m), first, second)))
+        if len(nodes) % 2 == 1:
+            paired.append(nodes[-1])
+        nodes = paired
+    return nodes[0][1]
 
 def decode_int(x, H):
+    return answer_blocking(int_decoder(x, H))
+
+def async_decode_int(x, H):
+    return answer_async(int_decoder(x, H))
+
+def int_decoder(x, H):
+    if has_form(x, "zero"):
+        raise Return(0)
+    elif has_form(x, "the additive inverse of []"):
+        n = yield int_decoder(x.args[0], H)
+        raise Return(-n)
+    elif has_form(x, "two times []"):
+        n = yield int_decoder(x.args[0], H)
+        raise Return(2 * n)
+    elif has_form(x, "two times [] plus one"):
+        n = yield int_decoder(x.args[0], H)
+        raise Return(2 * n + 1)
     agent = H
-    signm, agent = agent.act(Message("is [] negative, zero, or positive? (respond verbatim)", x))
+    signm, agent = yield Query(agent, Message("is [] negative, zero, or positive? (respond verbatim)", x))
     if signm == Message("negative"):
         sign = -1
         x = -x
     elif signm == Message("positive"):
         sign = 1
     elif signm == Message("zero"):
-        return 0
+        raise Return(0)
     else:
         raise Exception("sign is not 'negative', 'positive', or 'zero'")
-    paritym, agent  = agent.act(Message("is it even or odd? (respond verbatim)"))
+    paritym, agent  = yield Query(agent, Message("is it even or odd? (respond verbatim)"))
     if paritym == Message("even"):
         parity = 0
     elif paritym == Message("odd"):
         parity = 1
     else:
         raise Exception("Parity is not 'even' or 'odd'")
-    half, agent = agent.act(Message("what is half of it, rounded towards zero?"))
-    return sign * (2 * decode_int(half, H) + parity)
+    half, agent = yield Query(agent, Message("what is half of it, rounded towards zero?"))
+    n = yield int_decoder(half, H)
+    raise Return(sign * (2 * n + parity))
 
 def encode_int(x):
     if x == 0:
@@ -113,7 +277,196 @@ def encode_int(x):
     raise Exception()
 
 def decode_float(x, H):
+    return answer_blocking(float_decoder(x, H))
+
+def async_decode_float(x, H):
+    return answer_async(float_decoder(x, H))
+
+def float_decoder(x, H):
     agent = H
-    A, agent = agent.act(Message("represent [] as A * 2^B; what is A?", x))
-    B, agent = agent.act(Message("and what is B?"))
-    return decode_int(A, H) * 1.0 / 2**decode_int(B, H)
+    A, agent = yield Query(agent, Message("represent [] as A * 2^B; what is A?", x))
+    B, agent = yield Query(agent, Message("and what is B?"))
+    a = yield int_decoder(A, H)
+    b = yield int_decoder(B, H)
+    raise Return(a * 1.0 / 2**b)
+
+#-----encodings
+
+class Encoding(object):
+    """
+    An Encoding converts python objects into Messages,
+    and uses an agent to convert Messages back into python objects.
+
+    The default Encoding uses the functions above,
+    which spell out strings one character at a time and integers one bit at a time.
+    Subclasses override the encoders and the decoders (str_decoder etc.),
+    which decode_str and async_decode_str etc. run.
+    """
+
+    def encode_str(self, x):
+        return encode_str(x)
+
+    def str_decoder(self, x, H):
+        return str_decoder(x, H)
+
+    def encode_list(self, x):
+        return encode_list(x)
+
+    def list_decoder(self, x, H):
+        return list_decoder(x, H)
+
+    def list_element_decoder(self, x, i, H):
+        return list_element_decoder(x, i, H, self.encode_int)
+
+    def encode_int(self, x):
+        return encode_int(x)
+
+    def int_decoder(self, x, H):
+        return int_decoder(x, H)
+
+    def decode_str(self, x, H):
+        return answer_blocking(self.str_decoder(x, H))
+
+    def async_decode_str(self, x, H):
+        return answer_async(self.str_decoder(x, H))
+
+    def decode_list(self, x, H):
+        return answer_blocking(self.list_decoder(x, H))
+
+    def async_decode_list(self, x, H):
+        return answer_async(self.list_decoder(x, H))
+
+    def decode_list_element(self, x, i, H):
+        return answer_blocking(self.list_element_decoder(x, i, H))
+
+    def async_decode_list_element(self, x, i, H):
+        return answer_async(self.list_element_decoder(x, i, H))
+
+    def decode_int(self, x, H):
+        return answer_blocking(self.int_decoder(x, H))
+
+    def async_decode_int(self, x, H):
+        return answer_async(self.int_decoder(x, H))
+
+binary = Encoding()
+
+digit_names = ("zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine")
+
+#characters that an overseer can type back verbatim
+literal_chars = set(string.ascii_letters + " ,!?+-/*.;:_<>=&%{}'")
+literal_chunk = re.compile(r'^the literal text "(.*)"$', re.DOTALL)
+
+class ChunkedEncoding(Encoding):
+    """
+    Spells out strings in chunks of up to chunk_size characters, and integers one decimal digit at a time,
+    so decoding takes a number of queries proportional to the number of chunks or digits
+    rather than the number of characters or bits.
+
+    Runs of characters that can be typed verbatim form literal chunks;
+    any other character is a chunk of its own, described by its character code.
+    """
+
+    def __init__(self, chunk_size=16):
+        self.chunk_size = chunk_size
+
+    def chunks(self, x):
+        chunk = ""
+        for c in x:
+            if c in literal_chars and len(chunk) < self.chunk_size:
+                chunk += c
+                continue
+            if chunk:
+                yield chunk
+            if c in literal_chars:
+                chunk = c
+            else:
+                chunk = ""
+                yield c
+        if chunk:
+            yield chunk
+
+    def encode_str(self, x):
+        chunk_list = self.encode_list([self.encode_chunk(c) for c in self.chunks(x)])
+        return Message("the string with list of chunks []", chunk_list)
+
+    def str_decoder(self, x, H):
+        if has_form(x, "the string with list of chunks []"):
+            chunk_list = x.args[0]
+        else:
+            chunk_list, _ = yield Query(H, Message("what is the list of chunks in []?", x))
+        chunks = yield self.list_decoder(chunk_list, H)
+        result = []
+        for chunk in chunks:
+            text = yield self.chunk_decoder(chunk, H)
+            result.append(text)
+        raise Return("".join(result))
+
+    def encode_chunk(self, x):
+        if all(c in literal_chars for c in x):
+            return Message('the literal text "{}"'.format(x))
+        return Message("the character with code []", self.encode_int(ord(x)))
+
+    def chunk_decoder(self, x, H):
+        if isinstance(x, Message) and x.size == 0 and literal_chunk.match(x.text[0]):
+            raise Return(literal_chunk.match(x.text[0]).group(1))
+        elif has_form(x, "the character with code []"):
+            n = yield self.int_decoder(x.args[0], H)
+            raise Return(chr(n))
+        agent = H
+        kindm, agent = yield Query(agent, Message("is [] literal text or a character code? (respond verbatim)", x))
+        if kindm == Message("literal text"):
+            textm, agent = yield Query(agent, Message("what is the text? (respond verbatim, without quotes)"))
+            if textm.size > 0:
+                raise Exception("literal text should not contain any referents")
+            raise Return(textm.text[0])
+        elif kindm == Message("character code"):
+            code, agent = yield Query(agent, Message("what is the code?"))
+            n = yield self.int_decoder(code, H)
+            raise Return(chr(n))
+        else:
+            raise Exception("chunk is not 'literal text' or 'character code'")
+
+    def encode_int(self, x):
+        if x < 0:
+            return Message("the additive inverse of []", self.encode_int(-x))
+        digits = [Message("the digit {}".format(digit_names[int(d)])) for d in str(x)]
+        return Message("the number with decimal digits []", self.encode_list(digits))
+
+    def int_decoder(self, x, H):
+        if has_form(x, "the additive inverse of []"):
+            n = yield self.int_decoder(x.args[0], H)
+            raise Return(-n)
+        elif has_form(x, "the number with decimal digits []"):
+            n = yield self.digits_decoder(x.args[0], H)
+            raise Return(n)
+        agent = H
+        signm, agent = yield Query(agent, Message("is [] negative, zero, or positive? (respond verbatim)", x))
+        if signm == Message("zero"):
+            raise Return(0)
+        elif signm == Message("negative"):
+            inverse, agent = yield Query(agent, Message("what is its additive inverse?"))
+            n = yield self.int_decoder(inverse, H)
+            raise Return(-n)
+        elif signm != Message("positive"):
+            raise Exception("sign is not 'negative', 'positive', or 'zero'")
+        digit_list, agent = yield Query(agent, Message("what is the list of its decimal digits, most significant first?"))
+        n = yield self.digits_decoder(digit_list, H)
+        raise Return(n)
+
+    def digits_decoder(self, x, H):
+        digits = yield self.list_decoder(x, H)
+        result = 0
+        for digit in digits:
+            d = yield self.digit_decoder(digit, H)
+            result = 10 * result + d
+        raise Return(result)
+
+    def digit_decoder(self, x, H):
+        for i, name in enumerate(digit_names):
+            if has_form(x, "the digit {}".format(name)):
+                raise Return(i)
+        namem, _ = yield Query(H, Message("which digit is []? (respond verbatim with its name)", x))
+        for i, name in enumerate(digit_names):
+            if namem == Message(name):
+                raise Return(i)
+        raise Exception("digit is not one of {}".format(", ".join(digit_names)))
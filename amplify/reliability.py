@@ -1,29 +1,80 @@
 from collections import defaultdict
+import metrics
 from agent import Agent
+from asynchronous import Query, Return, answer_async, answer_blocking, call
+from utils import parallel_map
 
-def amplify_reliability(A):
-    return Ensemble((A, A, A))
+def amplify_reliability(A, size=3, **kwargs):
+    return Ensemble((A,) * size, **kwargs)
 
 def unzip(xs):
     xs = tuple(xs)
     return tuple(tuple(x[i] for x in xs) for i in range(len(xs[0])))
 
-def dialog(agents, initial_message):
+class EnsembleStats(object):
+    """
+    Counts the calls made by an Ensemble and its successors,
+    and the calls that were saved by capping dialogs or skipping votes
+    """
+
+    def __init__(self):
+        self.rounds = 0
+        self.dialog_calls = 0
+        self.dialog_calls_saved = 0
+        self.votes = 0
+        self.votes_saved = 0
+
+def dialog(agents, initial_message, max_rounds=None, max_tokens=None, stats=None):
+    """
+    Lets the agents talk in turn until each of them says 'done',
+    or until there have been max_rounds rounds or max_tokens words have been said.
+
+    Everything said goes in one shared log, and each agent is shown the part of the log
+    that it hasn't seen yet (including its own last message).
+    """
+    return answer_blocking(dialog_turns(agents, initial_message, max_rounds, max_tokens, stats))
+
+def async_dialog(agents, initial_message, max_rounds=None, max_tokens=None, stats=None):
+    """
+    a coroutine that runs dialog, letting asynchronous agents take their turns without blocking
+    """
+    return answer_async(dialog_turns(agents, initial_message, max_rounds, max_tokens, stats))
+
+def dialog_turns(agents, initial_message, max_rounds, max_tokens, stats):
+    """
+    the dialog, as a generator that yields a Query for each turn (see answer_blocking)
+    """
     agents = list(agents)
     N = len(agents)
-    to = ["(You are {}. Once you have decided, say 'done'.)\n{}".format(i, initial_message) for i in range(N)]
+    stats = EnsembleStats() if stats is None else stats
+    log = []
+    #cursors[i] is the length of the log when agent i last spoke, or None if it hasn't yet
+    cursors = [None for i in range(N)]
     done = [False for i in range(N)]
+    rounds = tokens = 0
     while not all(done):
+        if (max_rounds is not None and rounds >= max_rounds) or (max_tokens is not None and tokens >= max_tokens):
+            stats.dialog_calls_saved += done.count(False)
+            metrics.increment("Ensemble.dialog_calls_saved", done.count(False))
+            break
         for i in range(N):
             if not done[i]:
-                message, agents[i] = agents[i].act(to[i])
-                to[i] = ""
+                unseen = "\n".join(log[cursors[i] or 0:])
+                if cursors[i] is None:
+                    header = "(You are {}. Once you have decided, say 'done'.)\n{}".format(i, initial_message)
+                    unseen = "{}\n{}".format(header, unseen) if unseen else header
+                cursors[i] = len(log)
+                message, agents[i] = yield Query(agents[i], unseen)
+                stats.dialog_calls += 1
+                metrics.increment("Ensemble.dialog_calls")
                 if message == "done":
                     done[i] = True
-                message = "{} says: {}".format(i, message)
-                for j in range(N):
-                    to[j] = "{}\n{}".format(to[j], message) if to[j] else message
-    return tuple(agents)
+                tokens += len(message.split())
+                log.append("{} says: {}".format(i, message))
+        rounds += 1
+        stats.rounds += 1
+        metrics.increment("Ensemble.dialog_rounds")
+    raise Return(tuple(agents))
 
 def run_election(votes):
     vote_counts = defaultdict(lambda : 0)
@@ -42,26 +93,87 @@ def run_election(votes):
     return winner
 
 class Ensemble(Agent):
+    """
+    workers: the number of members that may be asked to propose, vote or acknowledge at once;
+    if this is more than 1 then the members must be safe to call from several threads.
+    The result is the same for any number of workers.
+
+    quorum: if every member proposes the same action, take it without voting
+    max_rounds, max_tokens: limits on the length of the discussion, see dialog
+    stats: an EnsembleStats shared with this Ensemble's successors
+    """
 
-    def __init__(self, agents):
+    def __init__(self, agents, workers=1, quorum=False, max_rounds=None, max_tokens=None, stats=None):
         self.agents = agents
+        self.workers = workers
+        self.quorum = quorum
+        self.max_rounds = max_rounds
+        self.max_tokens = max_tokens
+        self.stats = EnsembleStats() if stats is None else stats
+
+    def successor(self, agents):
+        return Ensemble(agents, self.workers, self.quorum, self.max_rounds, self.max_tokens, self.stats)
+
+    def ask_all(self, agents, message):
+        return unzip(parallel_map(lambda agent: agent.act(message), agents, self.workers))
+
+    def unanimous(self, actions):
+        if self.quorum and len(set(actions)) == 1:
+            self.stats.votes_saved += len(actions)
+            metrics.increment("Ensemble.votes_saved", len(actions))
+            return True
+        self.stats.votes += len(actions)
+        metrics.increment("Ensemble.votes", len(actions))
+        return False
 
     def act(self, observation):
-        agents = self.agents
-        intro = (
-            "Discuss amongst yourselves and decide what you want to do. "
-            "The next observation will be displayed after this."
-        )
-        intro += "\n\n{}".format(observation)
-        agents = dialog(agents, intro)
-        actions, agents = unzip(agent.act("what action do you propose?") for agent in agents)
-        vote_query = (
-            "which of these proposals do you approve of? "
-            "enter the numbers one by one, separated by commas"
-        )
-        summary = "\n".join("{} proposes: {}".format(i, action) for i, action in enumerate(actions))
-        message = "{}\n\n{}".format(vote_query, summary)
-        votes, agents = unzip(agent.act(message) for agent in agents)
-        pick = run_election(votes)
-        _, agents = unzip(agent.act("action {} won (just say 'OK')".format(pick)) for agent in agents)
-        return actions[pick], Ensemble(agents)
+        with metrics.timed("Ensemble.act"):
+            agents = self.agents
+            agents = dialog(agents, intro(observation), self.max_rounds, self.max_tokens, self.stats)
+            actions, agents = self.ask_all(agents, "what action do you propose?")
+            if self.unanimous(actions):
+                pick, outcome = 0, agreement_message(actions[0])
+            else:
+                votes, agents = self.ask_all(agents, vote_message(actions))
+                pick = run_election(votes)
+                outcome = outcome_message(pick)
+            _, agents = self.ask_all(agents, outcome)
+            return actions[pick], self.successor(agents)
+
+    def async_act(self, observation):
+        with metrics.timed("Ensemble.act"):
+            agents = self.agents
+            agents = yield async_dialog(agents, intro(observation), self.max_rounds, self.max_tokens, self.stats)
+            results = yield [call(agent, "what action do you propose?") for agent in agents]
+            actions, agents = unzip(results)
+            if self.unanimous(actions):
+                pick, outcome = 0, agreement_message(actions[0])
+            else:
+                results = yield [call(agent, vote_message(actions)) for agent in agents]
+                votes, agents = unzip(results)
+                pick = run_election(votes)
+                outcome = outcome_message(pick)
+            results = yield [call(agent, outcome) for agent in agents]
+            _, agents = unzip(results)
+            raise Return((actions[pick], self.successor(agents)))
+
+def intro(observation):
+    message = (
+        "Discuss amongst yourselves and decide what you want to do. "
+        "The next observation will be displayed after this."
+    )
+    return "{}\n\n{}".format(message, observation)
+
+def vote_message(actions):
+    vote_query = (
+        "which of these proposals do you approve of? "
+        "enter the numbers one by one, separated by commas"
+    )
+    summary = "\n".join("{} proposes: {}".format(i, action) for i, action in enumerate(actions))
+    return "{}\n\n{}".format(vote_query, summary)
+
+def outcome_message(pick):
+    return "action {} won (just say 'OK')".format(pick)
+
+def agreement_message(action):
+    return "everyone proposed {}, so there was no vote (just say 'OK')".format(action)
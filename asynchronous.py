@@ -0,0 +1,365 @@
+import heapq
+import itertools
+import sys
+import threading
+import time
+import types
+from collections import deque, namedtuple
+from multiprocessing.pool import ThreadPool
+import six
+
+"""
+A minimal coroutine runtime, so that many episodes can wait on slow overseers at once.
+
+A coroutine is a generator. It may yield:
+
+* another coroutine, to run it and receive its result
+* a Future, to wait for its result
+* a list of coroutines and Futures, to run them concurrently and receive a list of their results
+
+Generators can't return values in python 2, so a coroutine returns x by raising Return(x).
+
+An asynchronous agent defines async_act(obs), a coroutine whose result is the same as act(obs)
+(see agent.AsyncAgent). Inside a coroutine, call(agent, obs) works whether or not agent is asynchronous.
+"""
+
+class Return(Exception):
+
+    def __init__(self, value=None):
+        super(Return, self).__init__()
+        self.value = value
+
+class Future(object):
+    """
+    A result that will become available later
+    """
+
+    def __init__(self):
+        self.done = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def set_result(self, value):
+        self.value = value
+        self.finish()
+
+    def set_error(self, error):
+        """
+        error: the sys.exc_info() of the exception to raise
+        """
+        self.error = error
+        self.finish()
+
+    def finish(self):
+        self.done = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        if self.done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def result(self):
+        if self.error is not None:
+            six.reraise(*self.error)
+        return self.value
+
+class Task(object):
+    """
+    Runs a coroutine on an EventLoop, with nested coroutines sharing a single stack
+    """
+
+    def __init__(self, loop, coroutine):
+        self.loop = loop
+        self.stack = [coroutine]
+        self.future = Future()
+        loop.call_soon(self.step, None, None)
+
+    def step(self, value, error):
+        while self.stack:
+            generator = self.stack[-1]
+            try:
+                if error is None:
+                    yielded = generator.send(value)
+                else:
+                    yielded = generator.throw(*error)
+            except Return as r:
+                self.stack.pop()
+                value, error = r.value, None
+                continue
+            except StopIteration:
+                self.stack.pop()
+                value, error = None, None
+                continue
+            except Exception:
+                self.stack.pop()
+                value, error = None, sys.exc_info()
+                continue
+            if isinstance(yielded, types.GeneratorType):
+                self.stack.append(yielded)
+                value, error = None, None
+                continue
+            self.loop.future(yielded).add_done_callback(self.resume)
+            return
+        if error is None:
+            self.future.set_result(value)
+        else:
+            self.future.set_error(error)
+
+    def resume(self, future):
+        self.loop.call_soon(self.step, future.value, future.error)
+
+class EventLoop(object):
+    """
+    Runs coroutines, interleaving them whenever one of them is waiting
+
+    threads: the number of threads available to run blocking calls, see in_thread
+    """
+
+    def __init__(self, threads=16):
+        self.ready = deque()
+        self.timers = []
+        self.counter = itertools.count()
+        self.lock = threading.Condition()
+        self.from_threads = []
+        self.threads = threads
+        self.pool = None
+        self.outstanding = 0
+
+    def call_soon(self, f, *args):
+        self.ready.append((f, args))
+
+    def call_later(self, delay, f, *args):
+        heapq.heappush(self.timers, (time.time() + delay, next(self.counter), f, args))
+
+    def call_soon_threadsafe(self, f, *args):
+        with self.lock:
+            self.from_threads.append((f, args))
+            self.lock.notify()
+
+    def spawn(self, coroutine):
+        """
+        starts running coroutine, and returns a Future for its result
+        """
+        return Task(self, coroutine).future
+
+    def future(self, x):
+        """
+        converts anything a coroutine can yield into a Future
+        """
+        if isinstance(x, Future):
+            return x
+        if isinstance(x, types.GeneratorType):
+            return self.spawn(x)
+        if isinstance(x, (list, tuple)):
+            return self.gather([self.future(y) for y in x])
+        raise Exception("coroutines can't yield {}".format(type(x)))
+
+    def gather(self, futures):
+        result = Future()
+        remaining = [len(futures)]
+        def done(future):
+            remaining[0] -= 1
+            if future.error is not None and not result.done:
+                result.set_error(future.error)
+            elif remaining[0] == 0 and not result.done:
+                result.set_result([f.value for f in futures])
+        if not futures:
+            result.set_result([])
+        for future in futures:
+            future.add_done_callback(done)
+        return result
+
+    def in_thread(self, f, *args):
+        """
+        runs the blocking call f(*args) on another thread, and returns a Future for its result
+        """
+        if self.pool is None:
+            self.pool = ThreadPool(self.threads)
+        result, finish = self.from_thread()
+        def run():
+            try:
+                value, error = f(*args), None
+            except Exception:
+                value, error = None, sys.exc_info()
+            finish(value, error)
+        self.pool.apply_async(run)
+        return result
+
+    def from_thread(self):
+        """
+        returns a Future, and a function finish(value=None, error=None) that any thread can call once to complete it;
+        until then the loop waits for it, as it does for in_thread, but without holding a thread
+        """
+        result = Future()
+        self.outstanding += 1
+        def done(value, error):
+            self.outstanding -= 1
+            if error is None:
+                result.set_result(value)
+            else:
+                result.set_error(error)
+        def finish(value=None, error=None):
+            self.call_soon_threadsafe(done, value, error)
+        return result, finish
+
+    def run_once(self):
+        with self.lock:
+            if not self.ready and not self.from_threads and self.outstanding:
+                timeout = self.timers[0][0] - time.time() if self.timers else None
+                if timeout is None or timeout > 0:
+                    self.lock.wait(timeout)
+            self.ready.extend(self.from_threads)
+            self.from_threads = []
+        if not self.ready and self.timers:
+            delay = self.timers[0][0] - time.time()
+            if delay > 0 and not self.outstanding:
+                time.sleep(delay)
+        while self.timers and self.timers[0][0] <= time.time():
+            _, _, f, args = heapq.heappop(self.timers)
+            self.ready.append((f, args))
+        for _ in range(len(self.ready)):
+            f, args = self.ready.popleft()
+            f(*args)
+
+    def run_until_complete(self, x):
+        future = self.future(x)
+        previous = getattr(current, "loop", None)
+        current.loop = self
+        try:
+            while not future.done:
+                if not (self.ready or self.timers or self.outstanding or self.from_threads):
+                    raise Exception("deadlock: nothing left to run, but the coroutine isn't finished")
+                self.run_once()
+        finally:
+            current.loop = previous
+        return future.result()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+current = threading.local()
+
+def current_loop():
+    loop = getattr(current, "loop", None)
+    if loop is None:
+        raise Exception("this can only be used from a coroutine running on an EventLoop")
+    return loop
+
+def run(coroutine):
+    """
+    runs coroutine to completion on a new EventLoop, and returns its result
+    """
+    loop = EventLoop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+def sleep(delay):
+    future = Future()
+    current_loop().call_later(delay, future.set_result, None)
+    return future
+
+def in_thread(f, *args):
+    return current_loop().in_thread(f, *args)
+
+def from_thread():
+    return current_loop().from_thread()
+
+def immediately(value):
+    """
+    a coroutine whose result is value
+    """
+    raise Return(value)
+    yield
+
+def call(agent, obs):
+    """
+    a coroutine that lets agent act on obs, whether or not it is asynchronous
+    """
+    if hasattr(agent, "async_act"):
+        return agent.async_act(obs)
+    return immediately(agent.act(obs))
+
+def call_budgeted(agent, obs, budget):
+    """
+    like call, but for BudgetedAgents
+    """
+    if hasattr(agent, "async_act"):
+        return agent.async_act(obs, budget)
+    return immediately(agent.act(obs, budget))
+
+#Code that should work both with blocking agents and inside coroutines, such as Meta's decoders,
+#can be written once as a generator that yields a Query whenever it needs an agent to act,
+#yields another such generator to receive its result, and returns by raising Return.
+#answer_blocking runs it by calling act, so blocking agents are used exactly as a blocking caller would use them,
+#and answer_async is a coroutine that runs it by calling call.
+
+Query = namedtuple("Query", ["agent", "obs"])
+
+def resume(stack, value, error):
+    """
+    resumes the generator on top of stack with value (or throws error into it), running nested generators,
+    until one of them yields a Query, which is returned;
+    when the outermost generator finishes, raises Return with its result, or its exception
+    """
+    while True:
+        try:
+            if error is None:
+                yielded = stack[-1].send(value)
+            else:
+                yielded = stack[-1].throw(*error)
+        except Return as r:
+            value, error = r.value, None
+        except StopIteration:
+            value, error = None, None
+        except Exception:
+            value, error = None, sys.exc_info()
+        else:
+            if isinstance(yielded, Query):
+                return yielded
+            stack.append(yielded)
+            value, error = None, None
+            continue
+        stack.pop()
+        if not stack:
+            if error is not None:
+                six.reraise(*error)
+            raise Return(value)
+
+def answer_blocking(generator):
+    """
+    runs generator to completion, answering each Query by calling act
+    """
+    stack = [generator]
+    value, error = None, None
+    try:
+        while True:
+            query = resume(stack, value, error)
+            try:
+                value, error = query.agent.act(query.obs), None
+            except Exception:
+                value, error = None, sys.exc_info()
+    except Return as r:
+        return r.value
+
+def answer_async(generator):
+    """
+    a coroutine that runs generator, answering each Query with call
+    """
+    stack = [generator]
+    value, error = None, None
+    while True:
+        #the Return raised when generator finishes is this coroutine's result
+        query = resume(stack, value, error)
+        try:
+            value, error = (yield call(query.agent, query.obs)), None
+        except Exception:
+            value, error = None, sys.exc_info()
@@ -0,0 +1,234 @@
+"""
+Measures the agent calculus end to end, with the scripted overseers in oracles.py standing in for Human.
+
+Run from the root of the repository:
+
+    python -m benchmarks.agents [--case NAME] [--output results.json]
+
+Each case is run at several sizes, each in a fresh interpreter so that its peak memory can be measured,
+and the results are written as JSON: wall time, overseer queries, maxrss, and every metrics counter.
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+def hch_tree(depth, release=None):
+    """
+    HCH answers a question by asking two subquestions and then one more, down to the given depth
+    """
+    from amplify import HCH
+    from amplify.message import Message
+    from oracles import replay
+    table = [(r"^(@\d+: )?{}q$".format("sub " * depth), ["reply leaf"])]
+    for level in range(depth):
+        sub = "sub " * (level + 1)
+        table.append((
+            r"^(@\d+: )?{}q$".format("sub " * level),
+            ["ask* ({0}q) ({0}q)".format(sub), "ask {}q".format(sub), "reply done"]
+        ))
+    HCH(replay(table), release=release).act(Message("q"))
+
+def hch_tree_reply(depth):
+    hch_tree(depth, release="reply")
+
+def hch_conversation(turns, release=None, depth=5):
+    """
+    HCH is asked the given number of questions in turn, answering each with a binary tree of subquestions
+    """
+    from amplify import HCH
+    from amplify.message import Message
+    from oracles import scripted
+    def policy(observations, actions):
+        question = observations[-1].split("\n")[0]
+        if question.startswith("the replies are"):
+            return "reply done"
+        level = question.count("sub ")
+        if level == depth:
+            return "reply leaf"
+        return "ask* ({0}q) ({0}q)".format("sub " * (level + 1))
+    agent = HCH(scripted(policy), release=release)
+    for turn in range(turns):
+        _, agent = agent.act(Message("q"))
+
+def hch_conversation_turn(turns):
+    hch_conversation(turns, release="turn")
+
+def hch_conversation_reply(turns):
+    hch_conversation(turns, release="reply")
+
+def sample_text(size):
+    text = "The quick brown fox, 1 of 2 (or 3), jumps over the lazy dog. "
+    return (text * (size // len(text) + 1))[:size]
+
+def meta(size, encoding=None):
+    """
+    Meta acts on a string of the given length;
+    the oracle's answers are opaque, so they are decoded by asking questions
+    """
+    from amplify import Meta
+    from oracles import MessageOracle
+    echo = lambda observations, actions: observations[-1]
+    Meta(MessageOracle(echo, encoding, opaque=True), encoding=encoding).act(sample_text(size))
+
+def meta_chunked(size):
+    from amplify import ChunkedEncoding
+    meta(size, ChunkedEncoding())
+
+def stateless_meta(size):
+    """
+    StatelessMeta acts for the given number of steps, re-encoding its whole history at each one
+    """
+    from amplify import StatelessMeta, ChunkedEncoding
+    from oracles import MessageOracle
+    encoding = ChunkedEncoding()
+    agent = StatelessMeta(MessageOracle(lambda observations, actions: "ok", encoding), encoding)
+    for i in range(size):
+        _, agent = agent.act(sample_text(20))
+
+def ensemble(size):
+    """
+    an Ensemble of the given number of members acts for ten steps
+    """
+    from amplify.reliability import Ensemble
+    from oracles import ensemble_member
+    agent = Ensemble(tuple(ensemble_member(lambda obs: "act on {}".format(obs)) for _ in range(size)))
+    for i in range(10):
+        _, agent = agent.act("observation {}".format(i))
+
+def memoizer(size):
+    """
+    a Memoizer plays the given number of four-step episodes, which cycle through ten scripts
+    """
+    from memoizer import Memoizer, SQLiteCache
+    from oracles import scripted
+    agent = Memoizer(scripted(lambda observations, actions: observations[-1][::-1]), SQLiteCache(":memory:"))
+    for episode in range(size):
+        A = agent
+        for step in range(4):
+            _, A = A.act("script {} step {}".format(episode % 10, step))
+
+def memoizer_alba(size):
+    """
+    memoizer_ALBA(H, 1) plays the given number of single-step episodes,
+    whose observations cycle through eight values, with caches kept in memory.
+
+    H answers every question in HCH by replying with a fixed string.
+    Deeper towers need an overseer that can answer the lower level's questions through HCH,
+    which would mean typing encoded strings that contain numbers.
+    """
+    from alba import make_ALBA
+    from amplify import stateless_amplify
+    from amplify.meta import encode_str
+    from memoizer import Memoizer, SQLiteCache
+    from oracles import ensemble_member
+    H = ensemble_member("reply {}".format(encode_str("k")))
+    ALBA = make_ALBA(
+        distill=lambda O, n: Memoizer(O, SQLiteCache(":memory:")),
+        amplify=lambda A, H, n: stateless_amplify(A)
+    )
+    agent = ALBA(H, 1)
+    for episode in range(size):
+        agent.act("observation {}".format(episode % 8))
+
+def memoizer_alba_depth(depth):
+    """
+    memoizer_ALBA(H, depth) plays eight single-step episodes, with caches kept in memory
+
+    Each level above the first plays H for the level below it, but can only give one answer,
+    so each Ensemble ends its discussion after one round and takes a unanimous proposal without a vote.
+    A level's answer is the reply of the HCH tree below it, decoded as a string.
+    Encoded strings can't be typed, since they spell out numbers,
+    so here a reply of plain text decodes to that text, and H proposes "reply reply ... k", with one "reply" per level.
+    """
+    from alba import make_ALBA
+    from amplify import ChunkedEncoding, HCH, StatelessMeta, amplify_reliability, hch_budget
+    from amplify.message import Message
+    from asynchronous import Return
+    from memoizer import Memoizer, SQLiteCache
+    from oracles import ensemble_member
+
+    class PlainText(ChunkedEncoding):
+
+        def str_decoder(self, x, H):
+            if isinstance(x, Message) and x.size == 0:
+                raise Return(x.text[0])
+            result = yield ChunkedEncoding.str_decoder(self, x, H)
+            raise Return(result)
+
+    encoding = PlainText()
+    H = ensemble_member("reply " * depth + "k")
+    ALBA = make_ALBA(
+        distill=lambda O, n: Memoizer(O, SQLiteCache(":memory:")),
+        amplify=lambda A, H, n: StatelessMeta(
+            HCH(amplify_reliability(A, quorum=True, max_rounds=1), hch_budget), encoding
+        )
+    )
+    agent = ALBA(H, depth)
+    for episode in range(8):
+        action, _ = agent.act("observation {}".format(episode))
+        assert action == "k"
+
+cases = OrderedDict([
+    ("hch_tree", (hch_tree, [2, 4, 6, 8])),
+    ("hch_tree_reply", (hch_tree_reply, [2, 4, 6, 8])),
+    ("hch_conversation", (hch_conversation, [10, 40, 160])),
+    ("hch_conversation_turn", (hch_conversation_turn, [10, 40, 160])),
+    ("hch_conversation_reply", (hch_conversation_reply, [10, 40, 160])),
+    ("meta", (meta, [16, 64, 256])),
+    ("meta_chunked", (meta_chunked, [16, 64, 256, 1024])),
+    ("stateless_meta", (stateless_meta, [4, 16, 64])),
+    ("ensemble", (ensemble, [3, 5, 9])),
+    ("memoizer", (memoizer, [100, 1000, 10000])),
+    ("memoizer_alba", (memoizer_alba, [1, 8, 64])),
+    ("memoizer_alba_depth", (memoizer_alba_depth, [1, 2, 3])),
+])
+
+def measure(name, size):
+    import metrics
+    f, _ = cases[name]
+    with metrics.collect() as collected:
+        start = time.time()
+        f(size)
+        elapsed = time.time() - start
+    return {
+        "case": name,
+        "size": size,
+        "wall_seconds": elapsed,
+        "overseer_queries": collected.counters.get("overseer.queries", 0),
+        "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "counters": dict(collected.counters),
+    }
+
+def run_isolated(name, size):
+    output = subprocess.check_output([sys.executable, "-m", "benchmarks.agents", "--case", name, "--size", str(size)])
+    return json.loads(output)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the agent calculus with scripted overseers")
+    parser.add_argument("--case", choices=list(cases), help="run only this case")
+    parser.add_argument("--size", type=int, help="run the case at only this size, in this interpreter")
+    parser.add_argument("--output", help="write the results to this file rather than stdout")
+    args = parser.parse_args(argv)
+    if args.size is not None:
+        if args.case is None:
+            parser.error("--size requires --case")
+        results = measure(args.case, args.size)
+    else:
+        names = [args.case] if args.case else list(cases)
+        results = {
+            "python": sys.version.split()[0],
+            "results": [run_isolated(name, size) for name in names for size in cases[name][1]],
+        }
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
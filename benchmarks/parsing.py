@@ -0,0 +1,61 @@
+"""
+Measures how quickly HCH parses commands.
+
+Run from the root of the repository:
+
+    python -m benchmarks.parsing
+"""
+import json
+import subprocess
+import sys
+import time
+
+responses = [
+    "ask what is #1 plus #2?",
+    "reply the answer is (a pair of #3 and (the city @4))",
+    "view #12",
+    "reflect",
+    "ask@3 $20 what do you mean by #5?",
+    "ask* (first #1) (second (nested #2))",
+    "this is not a command",
+    "return #7",
+]
+
+def nested(depth):
+    return "reply " + "(" * depth + "deep #1" + ")" * depth
+
+def import_time():
+    """
+    the time taken to import amplify.hch in a fresh interpreter
+    """
+    script = "import time; t = time.time(); import amplify.hch; print(time.time() - t)"
+    return float(subprocess.check_output([sys.executable, "-c", script]))
+
+def throughput(parse, strings, seconds=1.0):
+    """
+    the number of strings parsed per second
+    """
+    n = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        for s in strings:
+            parse(s)
+        n += len(strings)
+    return n / (time.time() - start)
+
+def main():
+    from amplify.hch import parse_command
+    uncached = getattr(parse_command, "__wrapped__", parse_command)
+    results = {
+        "import_seconds": import_time(),
+        "uncached_commands_per_second": throughput(uncached, responses),
+        "cached_commands_per_second": throughput(parse_command, responses),
+    }
+    for depth in (4, 8, 12):
+        start = time.time()
+        uncached(nested(depth))
+        results["nested_{}_seconds".format(depth)] = time.time() - start
+    return results
+
+if __name__ == "__main__":
+    print(json.dumps(main(), indent=2, sort_keys=True))
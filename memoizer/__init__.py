@@ -1 +1,4 @@
-from memoizer import Memoizer
+from memoizer import Memoizer, MessageMemoizer, MongoCache
+from cache import Cache, SQLiteCache, MemoryCache, LRUCache, LFUCache, TieredCache
+from transfer import export_cache, import_cache
+from snapshot import Snapshot, OverlayCache, write_snapshot
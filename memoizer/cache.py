@@ -0,0 +1,395 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+class Cache(object):
+    """
+    A Cache is a persistent map from transcript hashes to actions.
+    Memoizer uses it to remember what its agent did in each situation.
+    """
+
+    def lookup(self, key):
+        """
+        returns the value saved under key, or None if nothing has been saved
+        """
+        raise NotImplementedError("Caches must define lookup")
+
+    def save(self, key, value):
+        raise NotImplementedError("Caches must define save")
+
+    def items(self):
+        """
+        iterates over every (key, value) saved in the cache, without holding them all in memory
+        """
+        raise NotImplementedError("{} can't list its entries".format(type(self).__name__))
+
+    def lookup_many(self, keys):
+        """
+        returns the list of values saved under keys, with None for each key that has nothing saved;
+        caches that can look up many keys in one round trip should override this
+        """
+        return [self.lookup(key) for key in keys]
+
+    def save_many(self, items):
+        """
+        saves each (key, value) in items;
+        caches that can write many entries at once should override this
+        """
+        for key, value in items:
+            self.save(key, value)
+
+    def acquire(self, key, owner, lease):
+        """
+        tries to take a lease on key for owner, lasting lease seconds,
+        so that other processes wait for owner to save a value rather than computing it themselves;
+        returns whether it succeeded
+
+        A cache that isn't shared between processes has nobody to coordinate with,
+        so by default this always succeeds.
+        """
+        return True
+
+    def release(self, key, owner):
+        """
+        gives up owner's lease on key, if it still holds it
+
+        A cache that buffers its saves should keep the lease until the value saved under key
+        can be seen by other processes, or else they will compute it again.
+        """
+        pass
+
+class SQLiteCache(Cache):
+    """
+    A Cache stored in a SQLite database on disk.
+    Lookups happen in-process, so no Mongo server is required.
+    """
+
+    def __init__(self, path="memoizer.sqlite", name="memoizer"):
+        self.path = path
+        self.name = name
+        self.connected = False
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if not self.connected:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.text_factory = str
+            #WAL lets readers proceed while a write is in progress,
+            #and NORMAL sync avoids an fsync on every save
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID".format(self.name)
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS {}_leases (key TEXT PRIMARY KEY, owner TEXT, expires REAL) WITHOUT ROWID".format(self.name)
+            )
+            self.db.commit()
+            self.connected = True
+
+    def lookup(self, key):
+        with self.lock:
+            self.connect()
+            row = self.db.execute("SELECT value FROM {} WHERE key=?".format(self.name), (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def save(self, key, value):
+        with self.lock:
+            self.connect()
+            self.db.execute("INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)".format(self.name), (key, value))
+            self.db.commit()
+
+    #SQLite limits the number of parameters in a statement, so lookup_many asks about this many keys at a time
+    lookup_batch_size = 500
+
+    def lookup_many(self, keys):
+        keys = list(keys)
+        values = {}
+        with self.lock:
+            self.connect()
+            for i in range(0, len(keys), self.lookup_batch_size):
+                batch = keys[i:i+self.lookup_batch_size]
+                values.update(self.db.execute(
+                    "SELECT key, value FROM {} WHERE key IN ({})".format(self.name, ",".join("?" * len(batch))),
+                    batch
+                ))
+        return [values.get(key) for key in keys]
+
+    def save_many(self, items):
+        with self.lock:
+            self.connect()
+            self.db.executemany("INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)".format(self.name), items)
+            self.db.commit()
+
+    def items(self, page_size=1000):
+        """
+        pages through the table in key order, so that other threads can use the cache in between pages
+        """
+        last = None
+        while True:
+            with self.lock:
+                self.connect()
+                if last is None:
+                    page = self.db.execute(
+                        "SELECT key, value FROM {} ORDER BY key LIMIT ?".format(self.name), (page_size,)
+                    ).fetchall()
+                else:
+                    page = self.db.execute(
+                        "SELECT key, value FROM {} WHERE key > ? ORDER BY key LIMIT ?".format(self.name), (last, page_size)
+                    ).fetchall()
+            for item in page:
+                yield item
+            if len(page) < page_size:
+                return
+            last = page[-1][0]
+
+    def acquire(self, key, owner, lease):
+        now = time.time()
+        with self.lock:
+            self.connect()
+            #both statements run in one write transaction, so no other process can claim the key in between
+            self.db.execute("DELETE FROM {}_leases WHERE key=? AND expires<?".format(self.name), (key, now))
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO {}_leases (key, owner, expires) VALUES (?, ?, ?)".format(self.name),
+                (key, owner, now + lease)
+            )
+            self.db.commit()
+            return cursor.rowcount == 1
+
+    def release(self, key, owner):
+        with self.lock:
+            self.connect()
+            self.db.execute("DELETE FROM {}_leases WHERE key=? AND owner=?".format(self.name), (key, owner))
+            self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            self.connect()
+            return self.db.execute("SELECT COUNT(*) FROM {}".format(self.name)).fetchone()[0]
+
+class MemoryCache(Cache):
+    """
+    A bounded in-process Cache, meant to sit in front of a persistent one.
+
+    capacity: the maximum number of entries, or None for no bound
+    ttl: the number of seconds an entry lives for, or None if entries don't expire
+
+    Subclasses decide which entry to evict when the cache is full.
+    """
+
+    def __init__(self, capacity=100000, ttl=None):
+        if capacity is not None and capacity < 1:
+            raise ValueError("capacity should be at least 1, or None for no bound")
+        self.capacity = capacity
+        self.ttl = ttl
+        self.values = {}
+        self.expiry = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        with self.lock:
+            if key not in self.values:
+                return None
+            if self.ttl is not None and self.expiry[key] < time.time():
+                self.remove(key)
+                return None
+            self.touch(key)
+            return self.values[key]
+
+    def save(self, key, value):
+        with self.lock:
+            if key in self.values:
+                self.remove(key)
+            elif self.capacity is not None and len(self.values) >= self.capacity:
+                self.remove(self.victim())
+            self.values[key] = value
+            if self.ttl is not None:
+                self.expiry[key] = time.time() + self.ttl
+            self.insert(key)
+
+    def items(self):
+        now = time.time()
+        with self.lock:
+            return [
+                (key, value) for key, value in self.values.items()
+                if self.ttl is None or self.expiry[key] >= now
+            ]
+
+    def remove(self, key):
+        del self.values[key]
+        self.expiry.pop(key, None)
+        self.forget(key)
+
+    def __len__(self):
+        return len(self.values)
+
+    #the eviction policy is defined by these methods, which are called with the lock held
+
+    def insert(self, key):
+        raise NotImplementedError()
+
+    def touch(self, key):
+        raise NotImplementedError()
+
+    def forget(self, key):
+        raise NotImplementedError()
+
+    def victim(self):
+        raise NotImplementedError()
+
+class LRUCache(MemoryCache):
+    """
+    Evicts the least recently used entry
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(LRUCache, self).__init__(*args, **kwargs)
+        self.order = OrderedDict()
+
+    def insert(self, key):
+        self.order[key] = None
+
+    def touch(self, key):
+        del self.order[key]
+        self.order[key] = None
+
+    def forget(self, key):
+        del self.order[key]
+
+    def victim(self):
+        return next(iter(self.order))
+
+class LFUCache(MemoryCache):
+    """
+    Evicts the least frequently used entry, breaking ties by recency
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(LFUCache, self).__init__(*args, **kwargs)
+        self.counts = {}
+        #buckets[n] holds the keys used n times, least recently used first
+        self.buckets = defaultdict(OrderedDict)
+        self.min_count = 0
+
+    def insert(self, key):
+        self.counts[key] = 1
+        self.buckets[1][key] = None
+        self.min_count = 1
+
+    def touch(self, key):
+        n = self.forget(key)
+        self.counts[key] = n + 1
+        self.buckets[n+1][key] = None
+
+    def forget(self, key):
+        n = self.counts.pop(key)
+        bucket = self.buckets[n]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[n]
+            if self.min_count == n:
+                self.min_count = n + 1
+        return n
+
+    def victim(self):
+        if self.min_count not in self.buckets:
+            self.min_count = min(self.buckets)
+        return next(iter(self.buckets[self.min_count]))
+
+class CacheStats(object):
+    """
+    Counts the lookups served by one tier of a TieredCache;
+    the TieredCache's lock must be held to record a lookup
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.latency = 0.0
+
+    def record(self, hit, latency):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.latency += latency
+
+    @property
+    def lookups(self):
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self):
+        return self.hits * 1.0 / self.lookups if self.lookups else 0.0
+
+    @property
+    def mean_latency(self):
+        return self.latency / self.lookups if self.lookups else 0.0
+
+class TieredCache(Cache):
+    """
+    Consults a sequence of caches in order, e.g. an LRUCache in front of a MongoCache.
+
+    A hit in a later tier is copied into all of the earlier ones,
+    and saves are written through to every tier.
+    """
+
+    def __init__(self, tiers):
+        self.tiers = tuple(tiers)
+        self.tier_stats = tuple(CacheStats(type(tier).__name__) for tier in self.tiers)
+        #guards tier_stats; the tiers have locks of their own
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        for i, (tier, stats) in enumerate(zip(self.tiers, self.tier_stats)):
+            start = time.time()
+            value = tier.lookup(key)
+            latency = time.time() - start
+            with self.lock:
+                stats.record(value is not None, latency)
+            if value is not None:
+                for earlier in self.tiers[:i]:
+                    earlier.save(key, value)
+                return value
+        return None
+
+    def save(self, key, value):
+        for tier in self.tiers:
+            tier.save(key, value)
+
+    def save_many(self, items):
+        items = list(items)
+        for tier in self.tiers:
+            tier.save_many(items)
+
+    def items(self):
+        return self.tiers[-1].items()
+
+    #the last tier is the one shared between processes, so it holds the leases
+
+    def acquire(self, key, owner, lease):
+        return self.tiers[-1].acquire(key, owner, lease)
+
+    def release(self, key, owner):
+        self.tiers[-1].release(key, owner)
+
+    def stats(self):
+        """
+        returns a list with one dict of statistics per tier
+        """
+        with self.lock:
+            counts = [
+                {
+                    "tier": stats.name,
+                    "lookups": stats.lookups,
+                    "hits": stats.hits,
+                    "hit_rate": stats.hit_rate,
+                    "mean_latency": stats.mean_latency,
+                }
+                for stats in self.tier_stats
+            ]
+        for tier, entry in zip(self.tiers, counts):
+            entry["entries"] = len(tier) if hasattr(tier, "__len__") else None
+        return counts
@@ -1,15 +1,25 @@
 from agent import Agent
+from asynchronous import Return, call, from_thread, sleep
+import atexit
+import metrics
 import hashlib
 import pymongo
+import threading
+import time
+import uuid
+import weakref
 import six
 from utils import interleave, unweave
+from cache import Cache, MemoryCache, LRUCache
 
 def hashable(x):
-    return isinstance(x, six.string_types)
+    return isinstance(x, six.string_types) or hasattr(x, "content_hash")
 
 def md5(x):
     if isinstance(x, six.string_types):
         return hashlib.md5(x).digest().encode("base64")
+    if hasattr(x, "content_hash"):
+        return x.content_hash
     raise Exception("unhashable type {}".format(type(x)))
 
 def hash_append(h, x):
@@ -25,16 +35,156 @@ def hash_empty():
     """
     return md5("")
 
-class MongoCache(object):
+class Transcript(object):
+    """
+    An immutable sequence of hashable objects, stored as a pointer to its last element
+    and to the Transcript of everything before it.
+    Each Transcript carries its own hash, so extending one costs O(1),
+    and Transcripts are interned so that every sequence with a common prefix shares it.
+    """
+
+    __slots__ = ("parent", "last", "hash", "length", "__weakref__")
+
+    #maps (hash of parent, kind of last element, last element or its hash) to the Transcript with that parent and last element;
+    #strings are keyed by their text and everything else by its content hash, which a string could spell out
+    interned = weakref.WeakValueDictionary()
+
+    def __init__(self, parent=None, last=None):
+        self.parent = parent
+        self.last = last
+        if parent is None:
+            self.hash = hash_empty()
+            self.length = 0
+        else:
+            self.hash = hash_append(parent.hash, last)
+            self.length = parent.length + 1
+
+    def extend(self, x):
+        if isinstance(x, six.string_types):
+            key = (self.hash, "text", x)
+        else:
+            key = (self.hash, "hash", md5(x))
+        result = Transcript.interned.get(key)
+        if result is None:
+            result = Transcript(self, x)
+            Transcript.interned[key] = result
+        return result
+
+    @staticmethod
+    def from_sequence(xs):
+        result = empty_transcript
+        for x in xs:
+            result = result.extend(x)
+        return result
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        xs = []
+        node = self
+        while node.parent is not None:
+            xs.append(node.last)
+            node = node.parent
+        return reversed(xs)
+
+empty_transcript = Transcript()
+
+#one client per process; pymongo pools connections internally, so every MongoCache shares it
+mongo_client = None
+mongo_client_lock = threading.Lock()
+
+def shared_mongo_client():
+    global mongo_client
+    with mongo_client_lock:
+        if mongo_client is None:
+            mongo_client = pymongo.MongoClient(serverSelectionTimeoutMS=1000)
+        return mongo_client
+
+#the MongoCaches that buffer their saves, held weakly, so that they can be flushed at exit and when idle
+buffered_caches = weakref.WeakSet()
+buffered_caches_lock = threading.Lock()
+flusher = None
+
+#how often the flusher looks for caches whose flush_interval has passed without a save
+idle_poll = 1.0
+
+def register_buffered(cache):
+    global flusher
+    with buffered_caches_lock:
+        buffered_caches.add(cache)
+        if flusher is None and cache.flush_interval is not None:
+            flusher = threading.Thread(target=flush_idle_caches)
+            flusher.daemon = True
+            flusher.start()
+
+def buffered_list():
+    with buffered_caches_lock:
+        return list(buffered_caches)
+
+def flush_idle_caches():
+    while True:
+        time.sleep(idle_poll)
+        flush_idle()
+
+def flush_idle():
+    now = time.time()
+    for cache in buffered_list():
+        if cache.flush_interval is not None and now - cache.last_flush >= cache.flush_interval:
+            try:
+                cache.flush(wait=False)
+            except Exception:
+                #the saves stay pending, and the next flush tries again
+                pass
 
-    def __init__(self, name="memoizer"):
+@atexit.register
+def flush_buffered_caches():
+    for cache in buffered_list():
+        cache.flush()
+
+class MongoCache(Cache):
+    """
+    A Cache stored in the local Mongo database.
+
+    If batch_size or flush_interval is given, saves are buffered
+    and written with a single bulk_write once batch_size saves are pending
+    or flush_interval seconds have passed since the last flush.
+    A background thread also flushes caches that have been idle for flush_interval seconds,
+    checking every idle_poll seconds, and every buffered cache is flushed when the process exits.
+    Lookups consult the buffer first, so a cache always sees its own writes.
+    A lease on a buffered key is kept until its value is written (see release),
+    so other processes wait for the flush rather than computing the value again.
+
+    collection: use this collection rather than connecting to Mongo, e.g. a local mock
+    leases: the collection in which leases are kept (see Cache.acquire);
+    by default name + "_leases", in the same database as collection
+    """
+
+    def __init__(self, name="memoizer", batch_size=None, flush_interval=None, collection=None, leases=None):
         self.name = name
-        self.connected = False
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.leases = leases
+        self.pending = {}
+        self.flushing = {}
+        #maps each key whose lease has been released, but whose value hasn't been written yet, to the lease's owner
+        self.held = {}
+        self.last_flush = time.time()
+        #notified when a flush finishes
+        self.lock = threading.Condition()
+        self.collection = collection
+        self.connected = collection is not None
+        if self.buffered:
+            register_buffered(self)
+
+    @property
+    def buffered(self):
+        return self.batch_size is not None or self.flush_interval is not None
 
     def connect(self):
         if not self.connected:
             try:
-                self.db = pymongo.MongoClient(serverSelectionTimeoutMS=1000).cache
+                self.db = shared_mongo_client().cache
                 if self.name not in self.db.collection_names():
                     self.db.create_collection(self.name)
             except pymongo.errors.ServerSelectionTimeoutError:
@@ -43,6 +193,10 @@ class MongoCache(object):
             self.connected = True
 
     def lookup(self, key):
+        with self.lock:
+            for buffer in (self.pending, self.flushing):
+                if key in buffer:
+                    return buffer[key]
         self.connect()
         resp = self.collection.find_one({"key":key})
         if resp is None or "value" not in resp:
@@ -50,40 +204,301 @@ class MongoCache(object):
         return resp["value"]
 
     def save(self, key, value):
+        if not self.buffered:
+            self.connect()
+            self.collection.update_one({"key":key}, {"$set":{"value":value}}, upsert=True)
+            return
+        with self.lock:
+            self.pending[key] = value
+            due = (
+                (self.batch_size is not None and len(self.pending) >= self.batch_size) or
+                (self.flush_interval is not None and time.time() - self.last_flush >= self.flush_interval)
+            )
+        if due:
+            #if another thread is already flushing, this save will go out with the next flush
+            self.flush(wait=False)
+
+    def lookup_many(self, keys):
+        keys = list(keys)
+        values = {}
+        with self.lock:
+            for buffer in (self.flushing, self.pending):
+                values.update((key, buffer[key]) for key in keys if key in buffer)
+        missing = [key for key in keys if key not in values]
+        if missing:
+            self.connect()
+            for doc in self.collection.find({"key":{"$in":missing}, "value":{"$exists":True}}):
+                values.setdefault(doc["key"], doc["value"])
+        return [values.get(key) for key in keys]
+
+    def save_many(self, items):
+        if self.buffered:
+            for key, value in items:
+                self.save(key, value)
+            return
+        requests = [pymongo.UpdateOne({"key":key}, {"$set":{"value":value}}, upsert=True) for key, value in items]
+        if requests:
+            self.connect()
+            self.collection.bulk_write(requests, ordered=False)
+
+    def items(self):
+        """
+        streams the collection from Mongo, after writing any pending saves
+        """
+        if self.buffered:
+            self.flush()
         self.connect()
-        self.collection.update_one({"key":key}, {"$set":{"value":value}}, upsert=True)
+        for doc in self.collection.find({"value":{"$exists":True}}, {"_id":False, "key":True, "value":True}):
+            yield doc["key"], doc["value"]
+
+    def flush(self, wait=True):
+        """
+        writes all pending saves to Mongo
+
+        If another thread is flushing, waits for it to finish and then writes whatever is still pending;
+        with wait=False, leaves the pending saves to a later flush instead.
+        """
+        with self.lock:
+            if self.flushing and not wait:
+                return
+            while self.flushing:
+                self.lock.wait()
+            if not self.pending:
+                return
+            self.flushing, self.pending = self.pending, {}
+            self.last_flush = time.time()
+        try:
+            self.connect()
+            self.collection.bulk_write([
+                pymongo.UpdateOne({"key":key}, {"$set":{"value":value}}, upsert=True)
+                for key, value in self.flushing.items()
+            ], ordered=False)
+        except Exception:
+            with self.lock:
+                self.flushing.update(self.pending)
+                self.pending = self.flushing
+                self.flushing = {}
+                self.lock.notify_all()
+            raise
+        with self.lock:
+            self.flushing = {}
+            written = [(key, owner) for key, owner in self.held.items() if key not in self.pending]
+            for key, _ in written:
+                del self.held[key]
+            self.lock.notify_all()
+        if written:
+            self.lease_collection().bulk_write([
+                pymongo.DeleteOne({"_id":key, "owner":owner}) for key, owner in written
+            ], ordered=False)
+
+    def lease_collection(self):
+        if self.leases is None:
+            self.connect()
+            self.leases = self.collection.database[self.name + "_leases"]
+        return self.leases
+
+    def acquire(self, key, owner, lease):
+        leases = self.lease_collection()
+        now = time.time()
+        try:
+            leases.insert_one({"_id":key, "owner":owner, "expires":now + lease})
+            return True
+        except pymongo.errors.DuplicateKeyError:
+            pass
+        #whoever holds the lease may have crashed, in which case it will have expired
+        taken = leases.find_one_and_update(
+            {"_id":key, "expires":{"$lt":now}},
+            {"$set":{"owner":owner, "expires":now + lease}}
+        )
+        return taken is not None
+
+    def release(self, key, owner):
+        """
+        gives up owner's lease on key once the value saved under key has been written to Mongo
+        """
+        with self.lock:
+            if key in self.pending or key in self.flushing:
+                self.held[key] = owner
+                return
+        self.lease_collection().delete_one({"_id":key, "owner":owner})
+
+class Flight(object):
+    """
+    A computation of a missing cache entry, which other threads can wait for
+    """
+
+    def __init__(self):
+        self.owner = uuid.uuid4().hex
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
 
-#TODO generalize Memoizer to handle arbitrary Agents with serializable state,
-#implement agent hashing so that this is computationally efficient for HCH
+    def add_done_callback(self, callback):
+        """
+        calls callback() once the flight is finished, on the thread that finishes it
+        """
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def finish(self):
+        with self.lock:
+            self.done.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+class SingleFlight(object):
+    """
+    Makes sure that a missing entry of cache is computed once,
+    even if several threads or processes miss it at the same time.
+
+    Within a process, the first thread to miss a key computes it, and the others wait for it to finish;
+    coroutines wait on their EventLoop, without holding one of its threads.
+    That thread also takes a lease on the key from the cache (see Cache.acquire).
+    If another process holds the lease, it waits for that process to save a value,
+    polling every poll seconds, until the value appears or the lease expires.
+    A lease lasts lease seconds, which should be longer than the overseer takes to answer.
+
+    Every Memoizer sharing a cache shares its SingleFlight, see single_flight(cache);
+    it doesn't keep a reference to the cache, so that the cache can be collected.
+    """
+
+    lease = 600
+    poll = 0.1
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def join(self, key):
+        """
+        returns (flight, leader): the flight computing key, and whether the caller should compute it
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self.flights[key] = Flight()
+            return flight, True
+
+    def finish(self, cache, key, flight):
+        cache.release(key, flight.owner)
+        with self.lock:
+            del self.flights[key]
+        flight.finish()
+
+    def compute(self, cache, key, f, name):
+        """
+        returns the value saved under key in cache, calling f() to compute and save it unless someone else does;
+        name is the prefix of the metrics recorded
+        """
+        while True:
+            flight, leader = self.join(key)
+            if not leader:
+                metrics.increment(name + ".waits")
+                flight.done.wait()
+            else:
+                try:
+                    #the last flight for key may have saved it after the caller looked
+                    value = cache.lookup(key)
+                    if value is None and cache.acquire(key, flight.owner, self.lease):
+                        value = f()
+                        cache.save(key, value)
+                        metrics.increment(name + ".saves")
+                        return value
+                    if value is None:
+                        metrics.increment(name + ".lease_waits")
+                        time.sleep(self.poll)
+                finally:
+                    self.finish(cache, key, flight)
+            value = cache.lookup(key)
+            if value is not None:
+                metrics.increment(name + ".shared")
+                return value
+
+    def async_compute(self, cache, key, f, name):
+        """
+        like compute, but f() is a coroutine, and so is this
+        """
+        while True:
+            flight, leader = self.join(key)
+            if not leader:
+                metrics.increment(name + ".waits")
+                done, finish = from_thread()
+                flight.add_done_callback(finish)
+                yield done
+            else:
+                try:
+                    value = cache.lookup(key)
+                    if value is None and cache.acquire(key, flight.owner, self.lease):
+                        value = yield f()
+                        cache.save(key, value)
+                        metrics.increment(name + ".saves")
+                        raise Return(value)
+                    if value is None:
+                        metrics.increment(name + ".lease_waits")
+                        yield sleep(self.poll)
+                finally:
+                    self.finish(cache, key, flight)
+            value = cache.lookup(key)
+            if value is not None:
+                metrics.increment(name + ".shared")
+                raise Return(value)
+
+single_flights = weakref.WeakKeyDictionary()
+single_flights_lock = threading.Lock()
+
+def single_flight(cache):
+    """
+    returns the SingleFlight shared by every Memoizer that uses cache
+    """
+    with single_flights_lock:
+        result = single_flights.get(cache)
+        if result is None:
+            result = single_flights[cache] = SingleFlight()
+        return result
+
+#TODO generalize Memoizer to persist arbitrary Agents with serializable state
 
 class Memoizer(Agent):
+    """
+    Memoizer remembers what agent did in each situation, and defers to it in novel ones.
 
-    def __init__(self, agent, cache=None, transcript=(), transcript_hash=None):
+    cache: the Cache in which actions are stored,
+    e.g. a SQLiteCache if there is no Mongo server running locally
+
+    If several episodes miss the same situation at once, whether on different threads or in different processes
+    sharing cache, only one of them asks agent, and the rest wait for its answer (see SingleFlight).
+    """
+
+    def __init__(self, agent, cache=None, transcript=empty_transcript):
+        if not isinstance(transcript, Transcript):
+            transcript = Transcript.from_sequence(transcript)
         self.transcript = transcript
-        if transcript_hash is None:
-            transcript_hash = hash_empty()
-            for x in self.transcript: transcript_hash = hash_append(transcript_hash, x)
-        self.transcript_hash = transcript_hash
-        self.cache = cache or MongoCache()
+        self.cache = MongoCache() if cache is None else cache
         self.agent = agent 
         assert self.well_formed()
 
+    @property
+    def transcript_hash(self):
+        return self.transcript.hash
+
     def well_formed(self):
         return (
-            isinstance(self.transcript, tuple) and
-            all(hashable(x) for x in self.transcript) and
-            isinstance(self.transcript_hash, six.string_types) and
+            isinstance(self.transcript, Transcript) and
+            isinstance(self.cache, Cache) and
             isinstance(self.agent, Agent) and
             self.agent.state_free
         )
 
     def extend(self, x):
-        transcript = self.transcript + (x,)
-        transcript_hash = hash_append(self.transcript_hash, x)
-        return Memoizer(self.agent, self.cache, transcript, transcript_hash)
+        return Memoizer(self.agent, self.cache, self.transcript.extend(x))
 
     def set(self, observations, actions):
-        return Memoizer(self.agent, self.cache, interleave(observations, actions))
+        return Memoizer(self.agent, self.cache, Transcript.from_sequence(interleave(observations, actions)))
 
     def lookup(self):
         return self.cache.lookup(self.transcript_hash)
@@ -91,10 +506,86 @@ class Memoizer(Agent):
     def save(self, action):
         return self.cache.save(self.transcript_hash, action)
 
+    def checkpoint(self):
+        """
+        makes sure that everything memorized so far has reached the cache's storage
+        """
+        if hasattr(self.cache, "flush"):
+            self.cache.flush()
+
     def act(self, obs):
-        new = self.extend(obs)
-        act = new.lookup()
-        if act is None:
-            act = self.agent.set(*unweave(self.transcript)).act(obs)[0]
-            new.save(act)
-        return act, new.extend(act)
+        with metrics.timed("Memoizer.act"):
+            new = self.extend(obs)
+            act = new.lookup()
+            if act is None:
+                metrics.increment("Memoizer.misses")
+                ask = lambda: self.agent.set(*unweave(self.transcript)).act(obs)[0]
+                act = single_flight(self.cache).compute(self.cache, new.transcript_hash, ask, "Memoizer")
+            else:
+                metrics.increment("Memoizer.hits")
+            return act, new.extend(act)
+
+    def async_act(self, obs):
+        with metrics.timed("Memoizer.act"):
+            new = self.extend(obs)
+            act = new.lookup()
+            if act is None:
+                metrics.increment("Memoizer.misses")
+                act = yield single_flight(self.cache).async_compute(
+                    self.cache, new.transcript_hash, lambda: self.ask(obs), "Memoizer"
+                )
+            else:
+                metrics.increment("Memoizer.hits")
+            raise Return((act, new.extend(act)))
+
+    def ask(self, obs):
+        act, _ = yield call(self.agent.set(*unweave(self.transcript)), obs)
+        raise Return(act)
+
+class MessageMemoizer(Agent):
+    """
+    Like Memoizer, but works for any agent whose observations and actions are
+    strings or Messages, including agents that keep state such as HCH.
+
+    Transcripts are keyed using the content hashes of Messages.
+    Each entry stores the action together with the agent's next state,
+    so the cache must be kept in memory, and it should only be shared by
+    MessageMemoizers wrapping the same agent.
+    """
+
+    def __init__(self, agent, cache=None, transcript=empty_transcript):
+        self.agent = agent
+        self.cache = LRUCache() if cache is None else cache
+        self.transcript = transcript
+        assert self.well_formed()
+
+    def well_formed(self):
+        return (
+            isinstance(self.transcript, Transcript) and
+            isinstance(self.cache, MemoryCache) and
+            isinstance(self.agent, Agent)
+        )
+
+    def act(self, obs):
+        transcript = self.transcript.extend(obs)
+        entry = self.cache.lookup(transcript.hash)
+        if entry is None:
+            metrics.increment("MessageMemoizer.misses")
+            entry = single_flight(self.cache).compute(self.cache, transcript.hash, lambda: self.agent.act(obs), "MessageMemoizer")
+        else:
+            metrics.increment("MessageMemoizer.hits")
+        action, agent = entry
+        return action, MessageMemoizer(agent, self.cache, transcript.extend(action))
+
+    def async_act(self, obs):
+        transcript = self.transcript.extend(obs)
+        entry = self.cache.lookup(transcript.hash)
+        if entry is None:
+            metrics.increment("MessageMemoizer.misses")
+            entry = yield single_flight(self.cache).async_compute(
+                self.cache, transcript.hash, lambda: call(self.agent, obs), "MessageMemoizer"
+            )
+        else:
+            metrics.increment("MessageMemoizer.hits")
+        action, agent = entry
+        raise Return((action, MessageMemoizer(agent, self.cache, transcript.extend(action))))
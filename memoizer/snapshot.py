@@ -0,0 +1,244 @@
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import six
+from cache import Cache
+from transfer import open_text, parse_cache, read_records
+
+"""
+An immutable, memory-mapped hash table compiled from a Memoizer's cache,
+so that many worker processes can share one frozen cache without each loading a copy of it.
+
+    write_snapshot(SQLiteCache("memoizer.sqlite").items(), "memoizer.snapshot")
+    cache = OverlayCache(Snapshot("memoizer.snapshot"), SQLiteCache("new.sqlite"))
+    agent = Memoizer(A, cache)
+
+Snapshot maps the file read-only, so every process that opens it shares the OS's page cache,
+and a lookup only touches the pages holding one slot and one record.
+OverlayCache saves new entries in a writable cache and consults it when the snapshot misses.
+
+From the shell, compile a cache or an exported file (see transfer.py) with
+
+    python -m memoizer.snapshot sqlite:memoizer.sqlite memoizer.snapshot
+
+The file is a header, the records (each a key length, a value length, the key and the value),
+and an open addressing table of (fingerprint, record offset) slots, at most half full and probed linearly.
+Everything is little-endian. The fingerprint of a key is the first 8 bytes of its md5, with 0 marking an empty slot.
+"""
+
+magic = b"ALBASNP1"
+header = struct.Struct("<8sQQQQ") #magic, number of entries, end of the records, offset of the table, number of slots
+record = struct.Struct("<II")
+slot = struct.Struct("<QQ")
+
+def to_bytes(x):
+    return x.encode("utf-8") if isinstance(x, six.text_type) else x
+
+def from_bytes(x):
+    return x if six.PY2 else x.decode("utf-8")
+
+def fingerprint(key):
+    return struct.unpack("<Q", hashlib.md5(key).digest()[:8])[0] or 1
+
+def table_size(n):
+    slots = 8
+    while slots < 2 * n:
+        slots *= 2
+    return slots
+
+def write_snapshot(items, path):
+    """
+    compiles the (key, value) pairs in items into a snapshot at path; returns the number of entries.
+    If a key appears more than once, its last value is kept.
+
+    Only the table being filled in is held in memory, and it is mapped from the file.
+    The snapshot is written next to path and renamed into place, so readers never see half of one.
+    """
+    partial = path + ".tmp"
+    with open(partial, "w+b") as f:
+        f.write(b"\0" * header.size)
+        for key, value in items:
+            key, value = to_bytes(key), to_bytes(value)
+            f.write(record.pack(len(key), len(value)))
+            f.write(key)
+            f.write(value)
+        end = f.tell()
+        table_offset = (end + 7) // 8 * 8
+        n = count_records(f, end)
+        slots = table_size(n)
+        f.truncate(table_offset + slots * slot.size)
+        f.flush()
+        table = mmap.mmap(f.fileno(), 0)
+        try:
+            n = fill_table(table, end, table_offset, slots)
+            header.pack_into(table, 0, magic, n, end, table_offset, slots)
+            table.flush()
+        finally:
+            table.close()
+    os.rename(partial, path)
+    return n
+
+def records(data, start, end):
+    """
+    iterates over (offset, key) for each record in data[start:end]
+    """
+    offset = start
+    while offset < end:
+        key_length, value_length = record.unpack_from(data, offset)
+        key_start = offset + record.size
+        yield offset, data[key_start:key_start+key_length]
+        offset = key_start + key_length + value_length
+
+def count_records(f, end):
+    f.seek(header.size)
+    n = 0
+    offset = header.size
+    while offset < end:
+        key_length, value_length = record.unpack(f.read(record.size))
+        offset += record.size + key_length + value_length
+        f.seek(offset)
+        n += 1
+    return n
+
+def fill_table(data, end, table_offset, slots):
+    mask = slots - 1
+    n = 0
+    for offset, key in records(data, header.size, end):
+        h = fingerprint(key)
+        i = h & mask
+        while True:
+            position = table_offset + i * slot.size
+            existing, existing_offset = slot.unpack_from(data, position)
+            if existing == 0:
+                n += 1
+                break
+            if existing == h and key_at(data, existing_offset) == key:
+                break
+            i = (i + 1) & mask
+        slot.pack_into(data, position, h, offset)
+    return n
+
+def key_at(data, offset):
+    key_length, _ = record.unpack_from(data, offset)
+    return data[offset+record.size:offset+record.size+key_length]
+
+class Snapshot(Cache):
+    """
+    A read-only Cache backed by a file written by write_snapshot
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        found, self.count, self.end, self.table_offset, self.slots = header.unpack_from(self.data, 0)
+        if found != magic:
+            raise ValueError("{} is not a snapshot".format(path))
+        self.mask = self.slots - 1
+
+    def lookup(self, key):
+        offset = self.find(to_bytes(key))
+        return None if offset is None else from_bytes(self.value_at(offset))
+
+    def save(self, key, value):
+        raise Exception("a Snapshot can't be changed; save into an OverlayCache in front of it")
+
+    def items(self):
+        data = self.data
+        for offset, key in records(data, header.size, self.end):
+            #records that were replaced by a later value for the same key aren't in the table
+            if self.find(key) == offset:
+                yield from_bytes(key), from_bytes(self.value_at(offset))
+
+    def find(self, key):
+        """
+        returns the offset of key's record, or None if it has none
+        """
+        h = fingerprint(key)
+        i = h & self.mask
+        while True:
+            existing, offset = slot.unpack_from(self.data, self.table_offset + i * slot.size)
+            if existing == 0:
+                return None
+            if existing == h and key_at(self.data, offset) == key:
+                return offset
+            i = (i + 1) & self.mask
+
+    def value_at(self, offset):
+        key_length, value_length = record.unpack_from(self.data, offset)
+        start = offset + record.size + key_length
+        return self.data[start:start+value_length]
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.data.close()
+
+class OverlayCache(Cache):
+    """
+    Looks up keys in an immutable snapshot, and then in a writable cache that holds everything saved since.
+
+    Memoizer only saves keys that it has just missed, so a saved key is never shadowed by the snapshot.
+    Leases (see Cache.acquire) are kept by the overlay, which is the part shared with other writers.
+    """
+
+    def __init__(self, snapshot, overlay):
+        self.snapshot = snapshot
+        self.overlay = overlay
+
+    def lookup(self, key):
+        value = self.snapshot.lookup(key)
+        return self.overlay.lookup(key) if value is None else value
+
+    def lookup_many(self, keys):
+        keys = list(keys)
+        values = [self.snapshot.lookup(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        for i, value in zip(missing, self.overlay.lookup_many([keys[i] for i in missing])):
+            values[i] = value
+        return values
+
+    def save(self, key, value):
+        self.overlay.save(key, value)
+
+    def save_many(self, items):
+        self.overlay.save_many(items)
+
+    def items(self):
+        for item in self.snapshot.items():
+            yield item
+        for key, value in self.overlay.items():
+            if self.snapshot.lookup(key) is None:
+                yield key, value
+
+    def acquire(self, key, owner, lease):
+        return self.overlay.acquire(key, owner, lease)
+
+    def release(self, key, owner):
+        self.overlay.release(key, owner)
+
+    def flush(self):
+        if hasattr(self.overlay, "flush"):
+            self.overlay.flush()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile a Memoizer's cache into a snapshot")
+    parser.add_argument("source", help="sqlite:path[:table], mongo:collection, or a file written by memoizer.transfer")
+    parser.add_argument("path", help="where to write the snapshot")
+    args = parser.parse_args(argv)
+    if args.source.partition(":")[0] in ("sqlite", "mongo"):
+        n = write_snapshot(parse_cache(args.source).items(), args.path)
+    else:
+        f = open_text(args.source, "r")
+        try:
+            n = write_snapshot(read_records(f), args.path)
+        finally:
+            f.close()
+    sys.stderr.write("wrote {} entries to {}\n".format(n, args.path))
+
+if __name__ == "__main__":
+    main()
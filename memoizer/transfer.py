@@ -0,0 +1,182 @@
+import argparse
+import gzip
+import io
+import json
+import sys
+from itertools import islice
+from cache import SQLiteCache
+from memoizer import MongoCache
+
+"""
+Moves the contents of a Memoizer's cache between backends, or between machines.
+
+export_cache(cache, path) streams every (transcript hash, action) in cache to a gzipped file of JSON lines,
+and import_cache(cache, path) writes such a file into another cache, in batches,
+so a new node can start from the cache of an earlier run, or the caches of several runs can be merged.
+Both hold only a batch of records in memory at a time.
+
+From the shell:
+
+    python -m memoizer.transfer export sqlite:memoizer.sqlite memoizer.jsonl.gz
+    python -m memoizer.transfer import mongo:memoizer memoizer.jsonl.gz --on-conflict keep-last
+
+The values must be strings, as they are for Memoizer; a MessageMemoizer's cache can't be exported.
+"""
+
+format_name = "alba-memoizer-cache"
+format_version = 1
+
+policies = ("keep-first", "keep-last", "report")
+
+def open_text(path, mode):
+    """
+    opens path as text, gzipped if it ends in .gz; "-" is stdin or stdout
+    """
+    if path == "-":
+        return sys.stdin if mode == "r" else sys.stdout
+    if path.endswith(".gz"):
+        f = gzip.open(path, mode + "b")
+        #python 2's GzipFile lacks the read1 that TextIOWrapper needs
+        return io.TextIOWrapper(io.BufferedReader(f) if mode == "r" else f, encoding="utf-8")
+    return io.open(path, mode, encoding="utf-8")
+
+def write_line(f, x):
+    line = json.dumps(x, separators=(",", ":"))
+    if isinstance(line, bytes):
+        line = line.decode("utf-8")
+    f.write(line + u"\n")
+
+def export_cache(cache, path):
+    """
+    writes every entry of cache to path; returns the number written
+    """
+    n = 0
+    f = open_text(path, "w")
+    try:
+        write_line(f, {"format": format_name, "version": format_version})
+        for key, value in cache.items():
+            write_line(f, [key, value])
+            n += 1
+    finally:
+        if f is not sys.stdout:
+            f.close()
+    return n
+
+def read_records(f):
+    header = json.loads(f.readline() or "null")
+    if not isinstance(header, dict) or header.get("format") != format_name:
+        raise ValueError("not an exported cache")
+    if header.get("version") != format_version:
+        raise ValueError("can't read version {} of the export format".format(header.get("version")))
+    for line in f:
+        if line.strip():
+            key, value = json.loads(line)
+            yield key, value
+
+class ImportStats(object):
+
+    def __init__(self):
+        self.records = 0
+        self.written = 0
+        self.unchanged = 0
+        self.conflicts = 0
+
+    def as_dict(self):
+        return {"records": self.records, "written": self.written, "unchanged": self.unchanged, "conflicts": self.conflicts}
+
+def import_cache(cache, path, on_conflict="keep-first", batch_size=1000, report=None):
+    """
+    saves the entries exported to path into cache; returns an ImportStats
+
+    on_conflict: what to do when a key already has a different value,
+    either in cache or earlier in the file.
+    "keep-first" keeps the value that was there first.
+    "keep-last" replaces it.
+    "report" keeps the first value, and writes each conflict as a line of JSON to report (stderr by default).
+
+    Entries are looked up and saved batch_size at a time, using lookup_many and save_many.
+    """
+    if on_conflict not in policies:
+        raise ValueError("on_conflict should be one of {}".format(", ".join(policies)))
+    if on_conflict == "report" and report is None:
+        report = sys.stderr
+    stats = ImportStats()
+    f = open_text(path, "r")
+    try:
+        records = read_records(f)
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            stats.records += len(batch)
+            save_batch(cache, batch, on_conflict, report, stats)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return stats
+
+def save_batch(cache, batch, on_conflict, report, stats):
+    keys = []
+    imported = {}
+    for key, value in batch:
+        if key not in imported:
+            keys.append(key)
+            imported[key] = [value]
+        else:
+            imported[key].append(value)
+    writes = []
+    for key, existing in zip(keys, cache.lookup_many(keys)):
+        value = existing
+        for new in imported[key]:
+            if value is None:
+                value = new
+            elif new != value:
+                stats.conflicts += 1
+                kept, rejected = (new, value) if on_conflict == "keep-last" else (value, new)
+                if report is not None:
+                    write_line(report, {"key": key, "kept": kept, "rejected": rejected})
+                value = kept
+        if value == existing:
+            stats.unchanged += len(imported[key])
+        else:
+            writes.append((key, value))
+            stats.written += 1
+            stats.unchanged += len(imported[key]) - 1
+    if writes:
+        cache.save_many(writes)
+
+def parse_cache(spec):
+    """
+    parses "sqlite:path[:table]" or "mongo:collection" into a Cache
+    """
+    kind, _, rest = spec.partition(":")
+    if kind == "sqlite" and rest:
+        path, _, name = rest.partition(":")
+        return SQLiteCache(path, name or "memoizer")
+    if kind == "mongo":
+        return MongoCache(rest or "memoizer")
+    raise ValueError("a cache should be sqlite:path[:table] or mongo:collection, not {}".format(spec))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export or import the contents of a Memoizer's cache")
+    commands = parser.add_subparsers(dest="command")
+    export_parser = commands.add_parser("export", help="write a cache to a file")
+    export_parser.add_argument("cache", help="sqlite:path[:table] or mongo:collection")
+    export_parser.add_argument("path", help="the file to write, gzipped if it ends in .gz, or - for stdout")
+    import_parser = commands.add_parser("import", help="add exported files to a cache")
+    import_parser.add_argument("cache", help="sqlite:path[:table] or mongo:collection")
+    import_parser.add_argument("paths", nargs="+", help="the files to read, in order, or - for stdin")
+    import_parser.add_argument("--on-conflict", choices=policies, default="keep-first")
+    import_parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args(argv)
+    cache = parse_cache(args.cache)
+    if args.command == "export":
+        n = export_cache(cache, args.path)
+        sys.stderr.write("exported {} entries\n".format(n))
+    else:
+        for path in args.paths:
+            stats = import_cache(cache, path, args.on_conflict, args.batch_size)
+            sys.stderr.write("{}: {}\n".format(path, json.dumps(stats.as_dict(), sort_keys=True)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import atexit
+import json
+import math
+import sys
+import threading
+import time
+from collections import defaultdict
+
+"""
+Process-wide counters and latency histograms for agent calls.
+
+The wrappers record what they do under names like "Memoizer.hits" or "BudgetedHCH.act",
+and snapshot() reports everything recorded so far. For example, to count the overseer queries
+made by an episode:
+
+    with metrics.collect() as m:
+        memoizer_ALBA(Human, 2).act("hello")
+    print(m.counters["overseer.queries"])
+
+The registry is shared by every thread, so collect() sees calls made by other threads in the meantime.
+dump_at_exit() writes the final snapshot as JSON when the process exits.
+"""
+
+class Histogram(object):
+    """
+    Counts observed latencies in buckets whose bounds are powers of two microseconds
+    """
+
+    def __init__(self, count=0, total=0.0, buckets=None):
+        self.count = count
+        self.total = total
+        #buckets[e] is the number of latencies in (2**(e-1), 2**e] microseconds
+        self.buckets = defaultdict(int) if buckets is None else defaultdict(int, buckets)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        _, e = math.frexp(max(seconds * 1e6, 1.0))
+        self.buckets[e] += 1
+
+    def copy(self):
+        return Histogram(self.count, self.total, self.buckets)
+
+    def __sub__(self, other):
+        buckets = dict((e, n - other.buckets.get(e, 0)) for e, n in self.buckets.items())
+        return Histogram(self.count - other.count, self.total - other.total, dict((e, n) for e, n in buckets.items() if n))
+
+    def quantile(self, q):
+        """
+        an upper bound on the q-quantile of the observed latencies, in seconds
+        """
+        seen = 0
+        for e in sorted(self.buckets):
+            seen += self.buckets[e]
+            if seen >= q * self.count:
+                return 2.0 ** e / 1e6
+        return 0.0
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total_seconds": self.total,
+            "mean_seconds": self.total / self.count if self.count else 0.0,
+            "p50_seconds": self.quantile(0.5),
+            "p90_seconds": self.quantile(0.9),
+            "p99_seconds": self.quantile(0.99),
+        }
+
+class Snapshot(object):
+    """
+    The counters and histograms recorded up to some point, or between two points
+    """
+
+    def __init__(self, counters=None, histograms=None):
+        self.counters = defaultdict(int) if counters is None else defaultdict(int, counters)
+        self.histograms = {} if histograms is None else histograms
+
+    def __sub__(self, other):
+        counters = dict((name, n - other.counters.get(name, 0)) for name, n in self.counters.items())
+        histograms = {}
+        for name, histogram in self.histograms.items():
+            if name in other.histograms:
+                histogram = histogram - other.histograms[name]
+            if histogram.count:
+                histograms[name] = histogram
+        return Snapshot(dict((name, n) for name, n in counters.items() if n), histograms)
+
+    def as_dict(self):
+        return {
+            "counters": dict(self.counters),
+            "latencies": dict((name, histogram.as_dict()) for name, histogram in self.histograms.items()),
+        }
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+
+    def increment(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.histograms[name].observe(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return Snapshot(
+                dict(self.counters),
+                dict((name, histogram.copy()) for name, histogram in self.histograms.items())
+            )
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+registry = Registry()
+
+def increment(name, n=1):
+    registry.increment(name, n)
+
+def observe(name, seconds):
+    registry.observe(name, seconds)
+
+def snapshot():
+    return registry.snapshot()
+
+def reset():
+    registry.reset()
+
+class timed(object):
+    """
+    a context manager that records how long its body takes in the histogram name
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        registry.observe(self.name, time.time() - self.start)
+
+class collect(object):
+    """
+    a context manager whose value is filled in, on exit, with what was recorded during its body
+    """
+
+    def __enter__(self):
+        self.start = snapshot()
+        self.result = Snapshot()
+        return self.result
+
+    def __exit__(self, *exc_info):
+        difference = snapshot() - self.start
+        self.result.counters.update(difference.counters)
+        self.result.histograms.update(difference.histograms)
+
+def dump(path=None):
+    """
+    writes a snapshot as JSON to path, or to stderr if path is None
+    """
+    text = json.dumps(snapshot().as_dict(), indent=2, sort_keys=True)
+    if path is None:
+        sys.stderr.write(text + "\n")
+    else:
+        with open(path, "w") as f:
+            f.write(text + "\n")
+
+def dump_at_exit(path=None):
+    atexit.register(dump, path)
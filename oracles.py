@@ -0,0 +1,201 @@
+import re
+import metrics
+from agent import Agent, StatelessAgent
+from amplify.meta import binary, has_form, is_concatenation, literal_chunk
+from amplify.message import Message
+
+"""
+Scripted overseers, which stand in for Human so that the agent calculus can be run and benchmarked.
+
+Like elicit_input, each of them counts its answers as metrics' "overseer.queries".
+"""
+
+#----answering meta.py's questions
+
+class MessageOracle(Agent):
+    """
+    Operates on Messages, and answers every question that Meta, StatelessMeta and the decoders ask.
+    Its answer to "what string should be returned?" is given by policy(observations, actions),
+    as for a StatelessAgent; the history is kept in Meta's state.
+
+    opaque: if true, each answer is wrapped in a Message that the decoders don't recognize,
+    so that they have to take it apart by asking further questions,
+    as they would if a human had answered
+    """
+
+    def __init__(self, policy, encoding=None, opaque=False, subject=None):
+        self.policy = policy
+        self.encoding = binary if encoding is None else encoding
+        self.opaque = opaque
+        #the Message that follow-up questions like "what is its element?" are about
+        self.subject = subject
+
+    def wrap(self, x):
+        return Message("the oracle's answer []", x) if self.opaque else x
+
+    def unwrap(self, x):
+        while has_form(x, "the oracle's answer []"):
+            x = x.args[0]
+        return x
+
+    def reply(self, answer, subject=None):
+        """
+        answers with answer; follow-up questions are about subject, or about the same thing as before
+        """
+        subject = self.subject if subject is None else subject
+        return answer, MessageOracle(self.policy, self.encoding, self.opaque, subject)
+
+    def decode_str(self, x):
+        return self.encoding.decode_str(self.unwrap(x), self)
+
+    def decode_list(self, x):
+        return self.encoding.decode_list(self.unwrap(x), self)
+
+    def act(self, question):
+        metrics.increment("overseer.queries")
+        text = question.text[0]
+        args = [self.unwrap(arg) for arg in question.args]
+        x = args[0] if args else self.subject
+        if text.startswith("what string should be returned by an agent in state"):
+            state, obsm = args
+            observations, actions = self.history(state)
+            action = self.policy(observations + (self.decode_str(obsm),), actions)
+            actionm = self.encoding.encode_str(action)
+            new_state = Message("the state after observing [] and then saying [] in []", obsm, actionm, state)
+            return self.reply(self.wrap(actionm), new_state)
+        if text.startswith("what should the agent's state be"):
+            return self.reply(self.subject)
+        if text.startswith("what string should an agent output after observing"):
+            observations = tuple(self.decode_str(obs) for obs in self.decode_list(args[0]))
+            actions = tuple(self.decode_str(act) for act in self.decode_list(args[1]))
+            return self.reply(self.wrap(self.encoding.encode_str(self.policy(observations, actions))))
+        return self.answer_decoding(text, question, x)
+
+    def history(self, state):
+        observations, actions = [], []
+        while has_form(state, "the state after observing [] and then saying [] in []"):
+            obsm, actionm, state = state.args
+            observations.append(self.decode_str(obsm))
+            actions.append(self.decode_str(actionm))
+        return tuple(reversed(observations)), tuple(reversed(actions))
+
+    def answer_decoding(self, text, question, x):
+        wrap = self.wrap
+        if text in ("what is the list of characters in ", "what is the list of chunks in "):
+            return self.reply(wrap(x.args[0]))
+        if text == "is " and question.text[1].startswith(" empty, a singleton"):
+            if has_form(x, "the empty list"):
+                return self.reply(Message("empty"), x)
+            if has_form(x, "the list with the single element []"):
+                return self.reply(Message("singleton"), x)
+            if is_concatenation(x):
+                return self.reply(Message("concatenation"), x)
+        if text == "what is its element?":
+            return self.reply(wrap(x.args[0]))
+        if text == "what is the first list?":
+            return self.reply(wrap(x.args[0]))
+        if text == "what is the second list?":
+            return self.reply(wrap(x.args[1]))
+        if text == "what is element ":
+            i = self.encoding.decode_int(self.unwrap(question.args[0]), self)
+            elements = self.decode_list(question.args[1])
+            return self.reply(wrap(elements[i]))
+        if text == "what is the ASCII code of ":
+            return self.reply(wrap(x.args[0]))
+        if text == "is " and question.text[1].startswith(" negative, zero, or positive"):
+            return self.reply(Message(self.sign(x)), x)
+        if text == "is it even or odd? (respond verbatim)":
+            return self.reply(Message("odd" if has_form(x, "two times [] plus one") else "even"), x)
+        if text == "what is half of it, rounded towards zero?":
+            return self.reply(wrap(x.args[0]))
+        if text == "what is its additive inverse?":
+            return self.reply(wrap(x.args[0]))
+        if text == "what is the list of its decimal digits, most significant first?":
+            return self.reply(wrap(x.args[0]))
+        if text == "is " and question.text[1].startswith(" literal text or a character code"):
+            if x.size == 0 and literal_chunk.match(x.text[0]):
+                return self.reply(Message("literal text"), x)
+            return self.reply(Message("character code"), x)
+        if text == "what is the text? (respond verbatim, without quotes)":
+            return self.reply(Message(literal_chunk.match(x.text[0]).group(1)))
+        if text == "what is the code?":
+            return self.reply(wrap(x.args[0]))
+        if text == "which digit is ":
+            return self.reply(Message(x.text[0][len("the digit "):]))
+        raise Exception("the oracle can't answer {}".format(question))
+
+    def sign(self, x):
+        if has_form(x, "the additive inverse of []"):
+            return "negative"
+        if has_form(x, "zero"):
+            return "zero"
+        if has_form(x, "the number with decimal digits []"):
+            digits = self.encoding.decode_list(x.args[0], self)
+            if all(has_form(digit, "the digit zero") for digit in digits):
+                return "zero"
+        return "positive"
+
+#----scripted overseers for strings
+
+def scripted(policy):
+    """
+    a StatelessAgent following policy, whose answers count as overseer queries
+    """
+    def counted(observations, actions):
+        metrics.increment("overseer.queries")
+        return policy(observations, actions)
+    return StatelessAgent(counted)
+
+def replay(table, default="reply I don't know"):
+    """
+    An agent that plays the part of H in HCH by following a policy table.
+
+    table: a sequence of (pattern, responses) pairs;
+    the first pattern that matches the question (the first line of the first observation)
+    gives the responses to make, one per observation,
+    and the last response is repeated once the others are used up
+    """
+    rules = [(re.compile(pattern), responses) for pattern, responses in table]
+    def policy(observations, actions):
+        question = observations[0].split("\n")[0]
+        for pattern, responses in rules:
+            if pattern.search(question):
+                return responses[min(len(actions), len(responses) - 1)]
+        return default
+    return scripted(policy)
+
+def ensemble_member(propose):
+    """
+    An agent that takes part in an Ensemble's discussion without saying anything,
+    proposes propose(observation), approves of every proposal equal to its own,
+    and acknowledges the outcome.
+
+    propose: a function of the observation under discussion, or a constant action
+    """
+    if not callable(propose):
+        action = propose
+        propose = lambda observation: action
+    def policy(observations, actions):
+        obs = observations[-1]
+        if obs.startswith("(You are"):
+            return "done"
+        if obs == "what action do you propose?":
+            intro = last_index(observations, lambda o: o.startswith("(You are"))
+            return propose(discussed(observations[intro]))
+        if obs.startswith("which of these proposals"):
+            mine = actions[last_index(observations, lambda o: o == "what action do you propose?")]
+            proposals = re.findall(r"^(\d+) proposes: (.*)$", obs, re.MULTILINE)
+            return ",".join(i for i, proposal in proposals if proposal == mine)
+        return "OK"
+    return scripted(policy)
+
+def last_index(xs, p):
+    return max(i for i, x in enumerate(xs) if p(x))
+
+def discussed(intro):
+    """
+    the observation in the introduction to an Ensemble's discussion,
+    without what the other members said before this one first spoke
+    """
+    observation = intro.split("\n\n", 1)[1]
+    return re.sub(r"(\n\d+ says: .*)+\Z", "", observation)
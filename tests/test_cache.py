@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+from memoizer import LFUCache, LRUCache, SQLiteCache, TieredCache
+
+class SQLiteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "cache.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_saves_persist(self):
+        cache = SQLiteCache(self.path)
+        self.assertIsNone(cache.lookup("a"))
+        cache.save("a", "1")
+        cache.save("a", "2")
+        self.assertEqual(SQLiteCache(self.path).lookup("a"), "2")
+        self.assertEqual(len(cache), 1)
+
+    def test_many(self):
+        cache = SQLiteCache(self.path)
+        items = [("key {}".format(i), "value {}".format(i)) for i in range(1200)]
+        cache.save_many(items)
+        keys = [key for key, _ in items] + ["missing"]
+        self.assertEqual(cache.lookup_many(keys), [value for _, value in items] + [None])
+        self.assertEqual(sorted(cache.items(page_size=100)), sorted(items))
+
+    def test_leases(self):
+        cache = SQLiteCache(self.path)
+        other_process = SQLiteCache(self.path)
+        self.assertTrue(cache.acquire("a", "me", 60))
+        self.assertFalse(other_process.acquire("a", "them", 60))
+        #only the owner can release a lease
+        other_process.release("a", "them")
+        self.assertFalse(other_process.acquire("a", "them", 60))
+        cache.release("a", "me")
+        self.assertTrue(other_process.acquire("a", "them", 60))
+
+class MemoryCacheTest(unittest.TestCase):
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = LRUCache(capacity=2)
+        cache.save("a", "1")
+        cache.save("b", "2")
+        cache.lookup("a")
+        cache.save("c", "3")
+        self.assertEqual(sorted(cache.items()), [("a", "1"), ("c", "3")])
+
+    def test_lfu_evicts_least_frequently_used(self):
+        cache = LFUCache(capacity=2)
+        cache.save("a", "1")
+        cache.save("b", "2")
+        cache.lookup("b")
+        cache.lookup("a")
+        cache.lookup("a")
+        cache.save("c", "3")
+        self.assertEqual(sorted(cache.items()), [("a", "1"), ("c", "3")])
+
+    def test_capacity_must_be_positive(self):
+        self.assertRaises(ValueError, LRUCache, capacity=0)
+
+class TieredCacheTest(unittest.TestCase):
+
+    def test_hits_are_copied_forward(self):
+        directory = tempfile.mkdtemp()
+        try:
+            memory, disk = LRUCache(capacity=10), SQLiteCache(os.path.join(directory, "cache.sqlite"))
+            disk.save("a", "1")
+            cache = TieredCache([memory, disk])
+            self.assertEqual(cache.lookup("a"), "1")
+            self.assertEqual(memory.lookup("a"), "1")
+            self.assertEqual(cache.lookup("a"), "1")
+            self.assertIsNone(cache.lookup("b"))
+            cache.save("c", "3")
+            self.assertEqual(disk.lookup("c"), "3")
+            stats = cache.stats()
+            self.assertEqual([(s["lookups"], s["hits"]) for s in stats], [(3, 1), (2, 1)])
+            self.assertEqual([s["entries"] for s in stats], [2, 2])
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import threading
+import time
+import unittest
+from agent import StatelessAgent
+from amplify.hch import HCH
+from amplify.message import Message
+from memoizer.cache import LRUCache
+
+def question(observations):
+    #questions from another agent start with a pointer to it, like "@0: left"
+    return observations[0].split(": ", 1)[-1].split("\n")[0]
+
+class SubquestionCacheTest(unittest.TestCase):
+
+    def run_tree(self, top, cache):
+        asked = []
+        def policy(observations, actions):
+            q = question(observations)
+            asked.append(q)
+            if q == "top":
+                return top if not actions else "reply done"
+            if q in ("left", "right"):
+                return "ask what is two" if not actions else "reply ok"
+            return "reply two"
+        answer, _ = HCH(StatelessAgent(policy), 1000, cache=cache).act(Message("top"))
+        self.assertEqual(answer, Message("done"))
+        return asked
+
+    def test_same_subquestion_in_two_subtrees(self):
+        self.assertEqual(self.run_tree("ask* (left) (right)", None).count("what is two"), 2)
+        self.assertEqual(self.run_tree("ask* (left) (right)", LRUCache()).count("what is two"), 1)
+
+    def test_repeated_question_in_one_ask_all(self):
+        self.assertEqual(self.run_tree("ask* (left) (left)", None).count("left"), 4)
+        self.assertEqual(self.run_tree("ask* (left) (left)", LRUCache()).count("left"), 2)
+
+class ReleaseTest(unittest.TestCase):
+
+    def test_reply_outlives_its_turn(self):
+        def policy(observations, actions):
+            last = observations[-1].split("\n")[0]
+            if question(observations) == "child":
+                return "reply followed" if "follow up" in last else "reply ok"
+            if last == "top":
+                return "ask child"
+            if last.endswith(": ok"):
+                #the reply is "@n: ok", where @n is the child
+                return "reply " + last.split(":")[0]
+            if last.startswith("talk to"):
+                #"talk to @n", where @n is the child from the last turn
+                return "ask{} follow up".format(last.split()[-1])
+            return "reply " + last.split(": ", 1)[-1]
+        for release in [None, "turn", "reply"]:
+            agent = HCH(StatelessAgent(policy), 1000, release=release)
+            child, agent = agent.act(Message("top"))
+            answer, agent = agent.act(Message("talk to []", *child.args))
+            self.assertEqual(answer, Message("followed"), release)
+
+class WorkersTest(unittest.TestCase):
+
+    def test_tree_shares_its_workers(self):
+        lock = threading.Lock()
+        threads = set()
+        running = [0, 0]
+        def policy(observations, actions):
+            with lock:
+                threads.add(threading.current_thread().ident)
+                running[0] += 1
+                running[1] = max(running)
+            try:
+                q = question(observations)
+                if actions:
+                    return "reply done"
+                if len(q) < 3:
+                    #three levels of three subquestions each
+                    time.sleep(0.01)
+                    return "ask* ({0}a) ({0}b) ({0}c)".format(q)
+                return "reply leaf"
+            finally:
+                with lock:
+                    running[0] -= 1
+        agent = HCH(StatelessAgent(policy), 10 ** 8, workers=4)
+        for turn in range(2):
+            answer, agent = agent.act(Message(""))
+            self.assertEqual(answer, Message("done"))
+        self.assertLessEqual(len(threads), 4)
+        self.assertLessEqual(running[1], 4)
+        self.assertGreater(running[1], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,203 @@
+import threading
+import time
+import unittest
+import pymongo
+from agent import AsyncAgent, StatelessAgent
+from asynchronous import Return, in_thread, run, sleep
+from amplify.message import Message
+from memoizer import Memoizer, MongoCache, SQLiteCache
+from memoizer.memoizer import empty_transcript
+
+def matches(doc, query):
+    for field, condition in query.items():
+        if isinstance(condition, dict):
+            for op, x in condition.items():
+                if op == "$exists" and (field in doc) != x:
+                    return False
+                if op == "$in" and doc.get(field) not in x:
+                    return False
+                if op == "$lt" and not (field in doc and doc[field] < x):
+                    return False
+        elif doc.get(field) != condition:
+            return False
+    return True
+
+class MockCollection(object):
+    """
+    the part of a pymongo collection that MongoCache uses, kept in memory
+    """
+
+    def __init__(self):
+        self.docs = []
+        self.lock = threading.RLock()
+        self.bulk_writes = 0
+        self.fail = 0
+
+    def find_one(self, query):
+        with self.lock:
+            for doc in self.docs:
+                if matches(doc, query):
+                    return dict(doc)
+
+    def find(self, query, projection=None):
+        with self.lock:
+            return [dict(doc) for doc in self.docs if matches(doc, query)]
+
+    def update_one(self, query, update, upsert=False):
+        with self.lock:
+            for doc in self.docs:
+                if matches(doc, query):
+                    doc.update(update["$set"])
+                    return
+            if upsert:
+                doc = dict(query)
+                doc.update(update["$set"])
+                self.docs.append(doc)
+
+    def insert_one(self, doc):
+        with self.lock:
+            if self.find_one({"_id":doc["_id"]}) is not None:
+                raise pymongo.errors.DuplicateKeyError("duplicate key")
+            self.docs.append(dict(doc))
+
+    def find_one_and_update(self, query, update):
+        with self.lock:
+            for doc in self.docs:
+                if matches(doc, query):
+                    before = dict(doc)
+                    doc.update(update["$set"])
+                    return before
+
+    def delete_one(self, query):
+        with self.lock:
+            for doc in self.docs:
+                if matches(doc, query):
+                    self.docs.remove(doc)
+                    return
+
+    def bulk_write(self, requests, ordered=True):
+        with self.lock:
+            if self.fail:
+                self.fail -= 1
+                raise pymongo.errors.AutoReconnect("the mock is down")
+            self.bulk_writes += 1
+            for request in requests:
+                if isinstance(request, pymongo.UpdateOne):
+                    self.update_one(request._filter, request._doc, request._upsert)
+                else:
+                    self.delete_one(request._filter)
+
+def slow_overseer(answer, calls, delay=0.2):
+    def policy(observations, actions):
+        calls.append(answer)
+        time.sleep(delay)
+        return answer
+    return StatelessAgent(policy)
+
+class TranscriptTest(unittest.TestCase):
+
+    def test_string_spelling_a_content_hash(self):
+        message = Message("a message")
+        spelled = empty_transcript.extend(message.content_hash)
+        extended = empty_transcript.extend(message)
+        self.assertIsNot(spelled, extended)
+        self.assertIs(extended.last, message)
+        self.assertNotEqual(spelled.hash, extended.hash)
+        self.assertIs(empty_transcript.extend(message), extended)
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_threads_missing_together_ask_once(self):
+        calls = []
+        cache = SQLiteCache(":memory:")
+        answers = []
+        def act():
+            answers.append(Memoizer(slow_overseer("A", calls), cache).act("q")[0])
+        threads = [threading.Thread(target=act) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, ["A"])
+        self.assertEqual(answers, ["A"] * 8)
+
+    def test_stale_lease_is_taken_over(self):
+        calls = []
+        cache = SQLiteCache(":memory:")
+        memoizer = Memoizer(slow_overseer("A", calls, 0), cache)
+        key = memoizer.extend("q").transcript_hash
+        #a process that took the lease and then crashed
+        self.assertTrue(cache.acquire(key, "crashed", 0.3))
+        self.assertFalse(cache.acquire(key, "other", 0.3))
+        start = time.time()
+        self.assertEqual(memoizer.act("q")[0], "A")
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual(calls, ["A"])
+
+    def test_buffered_save_keeps_the_lease(self):
+        #two processes, each with its own buffered MongoCache on the same collections
+        collection, leases = MockCollection(), MockCollection()
+        caches = [MongoCache(batch_size=100, collection=collection, leases=leases) for _ in range(2)]
+        calls = []
+        answers = {}
+        def act(i, answer):
+            answers[i] = Memoizer(slow_overseer(answer, calls), caches[i]).act("q")[0]
+        first = threading.Thread(target=act, args=(0, "A"))
+        first.start()
+        time.sleep(0.05)
+        second = threading.Thread(target=act, args=(1, "B"))
+        second.start()
+        first.join()
+        time.sleep(0.2)
+        self.assertTrue(second.is_alive())
+        caches[0].flush()
+        second.join()
+        self.assertEqual(calls, ["A"])
+        self.assertEqual(answers, {0: "A", 1: "A"})
+        self.assertEqual(leases.docs, [])
+
+    def test_waiting_coroutines_hold_no_threads(self):
+        calls = []
+        class Overseer(AsyncAgent):
+            def set(self, observations, actions):
+                return self
+            def async_act(self, obs):
+                calls.append(obs)
+                yield sleep(0.01)
+                answer = yield in_thread(lambda: "A")
+                raise Return((answer, self))
+        cache = SQLiteCache(":memory:")
+        def episodes():
+            results = yield [Memoizer(Overseer(), cache).async_act("q") for _ in range(40)]
+            raise Return([action for action, _ in results])
+        self.assertEqual(run(episodes()), ["A"] * 40)
+        self.assertEqual(calls, ["q"])
+
+class BufferedMongoCacheTest(unittest.TestCase):
+
+    def test_reads_its_own_writes(self):
+        collection = MockCollection()
+        cache = MongoCache(batch_size=3, collection=collection)
+        cache.save("a", "1")
+        cache.save("b", "2")
+        self.assertEqual(collection.docs, [])
+        self.assertEqual(cache.lookup("a"), "1")
+        self.assertEqual(cache.lookup_many(["b", "c"]), ["2", None])
+        cache.save("c", "3")
+        self.assertEqual(collection.bulk_writes, 1)
+        self.assertEqual(MongoCache(collection=collection).lookup("c"), "3")
+
+    def test_failed_flush_is_retried(self):
+        collection = MockCollection()
+        cache = MongoCache(batch_size=100, collection=collection)
+        cache.save("a", "1")
+        collection.fail = 1
+        self.assertRaises(pymongo.errors.AutoReconnect, cache.flush)
+        self.assertEqual(cache.lookup("a"), "1")
+        cache.save("b", "2")
+        cache.flush()
+        self.assertEqual(sorted(cache.items()), [("a", "1"), ("b", "2")])
+        self.assertEqual(cache.pending, {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+from agent import Delayed, StatelessAgent
+from amplify.hch import HCH
+from amplify.message import Message
+from amplify.meta import ChunkedEncoding, decode_list_element, decode_str, encode_list
+
+class SequentialDecodingTest(unittest.TestCase):
+
+    def test_one_worker_asks_in_order(self):
+        seen = []
+        def policy(observations, actions):
+            #questions from another agent start with a pointer to it, like "@0: first"
+            question = observations[0].split(": ", 1)[-1]
+            seen.append((question.split()[0], len(actions)))
+            if question.startswith("what is the list of characters"):
+                if not actions:
+                    return "ask* (first) (second)"
+                return "reply the empty list"
+            if question.startswith("detail"):
+                return "reply detail"
+            if not actions:
+                return "ask detail"
+            return "reply done"
+        #an overseer that makes its caller wait, as a human would, so that concurrent questions would interleave
+        agent = HCH(Delayed(StatelessAgent(policy), 0), 1000, workers=1)
+        self.assertEqual(decode_str(Message("an opaque string"), agent), "")
+        self.assertEqual(seen, [
+            ("what", 0),
+            ("first", 0), ("detail", 0), ("first", 1),
+            ("second", 0), ("detail", 0), ("second", 1),
+            ("what", 1),
+        ])
+
+class ListElementTest(unittest.TestCase):
+
+    def test_encoded_lists_are_read_without_asking(self):
+        def policy(observations, actions):
+            raise Exception("asked {}".format(observations[-1]))
+        elements = [Message("element {}".format(i)) for i in range(13)]
+        for encoding in (None, ChunkedEncoding()):
+            for i, element in enumerate(elements):
+                if encoding is None:
+                    found = decode_list_element(encode_list(elements), i, StatelessAgent(policy))
+                else:
+                    found = encoding.decode_list_element(encoding.encode_list(elements), i, StatelessAgent(policy))
+                self.assertIs(found, element)
+
+    def test_unrecognized_nodes_are_asked_about(self):
+        asked = []
+        def policy(observations, actions):
+            asked.append(observations[-1])
+            return Message("found it")
+        opaque = Message("an opaque list")
+        x = encode_list([Message("first"), Message("second")])
+        x = Message("the list of 5 elements made of [] followed by []", x, opaque)
+        self.assertEqual(decode_list_element(x, 1, StatelessAgent(policy)), Message("second"))
+        self.assertEqual(decode_list_element(x, 3, StatelessAgent(policy)), Message("found it"))
+        #element 3 of x is element 1 of the opaque list
+        self.assertEqual(asked, [Message("what is element [] of [] (counting from zero)?", Message("two times [] plus one", Message("zero")), opaque)])
+
+if __name__ == "__main__":
+    unittest.main()
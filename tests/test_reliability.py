@@ -0,0 +1,41 @@
+import unittest
+from agent import AsyncAgent
+from asynchronous import Return, run
+from amplify.reliability import Ensemble
+
+class Probe(AsyncAgent):
+    """
+    proposes "go" and then says "done", recording whether it was called through act or async_act
+    """
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def respond(self, obs):
+        return "done" if obs.startswith("(You are") or "says" in obs else "go"
+
+    def act(self, obs):
+        self.calls.append("act")
+        return self.respond(obs), self
+
+    def async_act(self, obs):
+        self.calls.append("async_act")
+        raise Return((self.respond(obs), self))
+        yield
+
+class EnsembleTest(unittest.TestCase):
+
+    def test_act_only_calls_act(self):
+        calls = []
+        action, _ = Ensemble((Probe(calls),) * 3, quorum=True).act("observation")
+        self.assertEqual(action, "go")
+        self.assertEqual(set(calls), set(["act"]))
+
+    def test_async_act_only_calls_async_act(self):
+        calls = []
+        action, _ = run(Ensemble((Probe(calls),) * 3, quorum=True).async_act("observation"))
+        self.assertEqual(action, "go")
+        self.assertEqual(set(calls), set(["async_act"]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+from memoizer import LRUCache, OverlayCache, Snapshot, write_snapshot
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "cache.snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_many_keys(self):
+        items = [("key {}".format(i), "value {}".format(i) * (i % 5)) for i in range(5000)]
+        self.assertEqual(write_snapshot(iter(items), self.path), 5000)
+        snapshot = Snapshot(self.path)
+        for key, value in items:
+            self.assertEqual(snapshot.lookup(key), value)
+        self.assertIsNone(snapshot.lookup("key 5000"))
+        self.assertEqual(sorted(snapshot.items()), sorted(items))
+        snapshot.close()
+
+    def test_duplicate_keys_keep_the_last_value(self):
+        items = [("a", "1"), ("b", "2"), ("a", "3"), ("c", ""), ("b", "4")]
+        self.assertEqual(write_snapshot(items, self.path), 3)
+        snapshot = Snapshot(self.path)
+        self.assertEqual(len(snapshot), 3)
+        self.assertEqual(snapshot.lookup_many(["a", "b", "c"]), ["3", "4", ""])
+        self.assertEqual(sorted(snapshot.items()), [("a", "3"), ("b", "4"), ("c", "")])
+        self.assertRaises(Exception, snapshot.save, "d", "5")
+
+        overlay = LRUCache()
+        cache = OverlayCache(snapshot, overlay)
+        cache.save("d", "5")
+        self.assertEqual(overlay.lookup("d"), "5")
+        self.assertEqual(cache.lookup_many(["a", "d", "e"]), ["3", "5", None])
+        self.assertEqual(sorted(cache.items()), [("a", "3"), ("b", "4"), ("c", ""), ("d", "5")])
+        snapshot.close()
+
+    def test_rejects_other_files(self):
+        with open(self.path, "wb") as f:
+            f.write(b"\0" * 64)
+        self.assertRaises(ValueError, Snapshot, self.path)
+
+if __name__ == "__main__":
+    unittest.main()
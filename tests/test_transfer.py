@@ -0,0 +1,64 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from memoizer import LRUCache, export_cache, import_cache
+
+class TransferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "cache.jsonl.gz")
+        source = LRUCache()
+        for key, value in [("a", "1"), ("b", "2"), (u"caf\xe9", u"\u2713")]:
+            source.save(key, value)
+        self.assertEqual(export_cache(source, self.path), 3)
+        #a later export, which disagrees about a, repeats b, and disagrees with itself about d
+        self.later = os.path.join(self.directory, "later.jsonl")
+        with io.open(self.later, "w", encoding="utf-8") as f:
+            f.write(u'{"format":"alba-memoizer-cache","version":1}\n')
+            for key, value in [("a", "one"), ("b", "2"), ("d", "4"), ("d", "four")]:
+                f.write(u"{}\n".format(json.dumps([key, value])))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def merged(self, on_conflict, report=None):
+        cache = LRUCache()
+        import_cache(cache, self.path)
+        stats = import_cache(cache, self.later, on_conflict, batch_size=3, report=report)
+        return dict(cache.items()), stats.as_dict()
+
+    def test_keep_first(self):
+        cache, stats = self.merged("keep-first")
+        self.assertEqual(cache, {"a": "1", "b": "2", u"caf\xe9": u"\u2713", "d": "4"})
+        self.assertEqual(stats, {"records": 4, "written": 1, "unchanged": 3, "conflicts": 2})
+
+    def test_keep_last(self):
+        cache, stats = self.merged("keep-last")
+        self.assertEqual(cache, {"a": "one", "b": "2", u"caf\xe9": u"\u2713", "d": "four"})
+        #the two values for d fall in different batches, so d is written twice
+        self.assertEqual(stats, {"records": 4, "written": 3, "unchanged": 1, "conflicts": 2})
+
+    def test_report(self):
+        report = io.StringIO()
+        cache, stats = self.merged("report", report)
+        self.assertEqual(cache["a"], "1")
+        self.assertEqual(cache["d"], "4")
+        conflicts = [json.loads(line) for line in report.getvalue().splitlines()]
+        self.assertEqual(conflicts, [
+            {"key": "a", "kept": "1", "rejected": "one"},
+            {"key": "d", "kept": "4", "rejected": "four"},
+        ])
+
+    def test_rejects_bad_input(self):
+        self.assertRaises(ValueError, import_cache, LRUCache(), self.path, "keep-both")
+        other = os.path.join(self.directory, "other.jsonl")
+        with io.open(other, "w", encoding="utf-8") as f:
+            f.write(u'["a", "1"]\n')
+        self.assertRaises(ValueError, import_cache, LRUCache(), other)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import threading
+import unittest
+import six
+from memoizer import Memoizer, LRUCache
+from workqueue import QueueServer, RemoteQueue, WorkQueue, Worker, overseer
+
+class RemoteAnswerTest(unittest.TestCase):
+
+    def test_non_ascii_answer(self):
+        queue = WorkQueue()
+        server = QueueServer(queue)
+        stop = threading.Event()
+        try:
+            Worker(RemoteQueue(server.url), lambda observations, actions: u"café").start(stop, poll=0.1)
+            #agents pass strings around as bytes on python 2
+            expected = u"café" if six.PY3 else u"café".encode("utf-8")
+            agent = Memoizer(overseer(queue), cache=LRUCache())
+            answer, agent = agent.act("what should I order?")
+            self.assertEqual(answer, expected)
+            #the answer is hashed into the transcript of the next question
+            answer, agent = agent.act("and after that?")
+            self.assertEqual(answer, expected)
+        finally:
+            stop.set()
+            server.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,303 @@
+import argparse
+import atexit
+import itertools
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+
+"""
+Opt-in tracing of where an HCH tree spends its time and budget.
+
+While a Tracer is enabled, BudgetedHCH.act, Ask.execute, Budgeter.act and Meta.act
+each record a span, with a link to the span that was running when they started.
+Spans are written as they finish, either as JSON lines or in Chrome's trace_event format
+(load the latter in chrome://tracing or https://ui.perfetto.dev).
+
+    with tracing.trace("hch.jsonl"):
+        HCH(H).act(question)
+
+Summarize a trace with
+
+    python tracing.py hch.jsonl
+
+When no Tracer is enabled, span() returns a shared null span, so tracing costs a few function calls.
+Spans nest through a thread-local stack, which parallel_map carries into its worker threads;
+coroutines interleave on a single thread, so the async_* methods are not traced.
+"""
+
+class Span(object):
+    """
+    A traced call; fields holds whatever the caller records about it
+    """
+
+    recording = True
+
+    def __init__(self, tracer, name, parent, fields):
+        self.tracer = tracer
+        self.name = name
+        self.id = next(tracer.ids)
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.fields = fields
+        self.thread = threading.current_thread().ident
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def add(self, field, amount):
+        self.fields[field] = self.fields.get(field, 0) + amount
+
+    def append(self, field, x):
+        self.fields.setdefault(field, []).append(x)
+
+    def __enter__(self):
+        stack().append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.time() - self.start
+        stack().pop()
+        if exc_info[0] is not None:
+            self.fields["error"] = exc_info[0].__name__
+        self.tracer.write(self)
+
+class NullSpan(object):
+    """
+    Stands in for a Span when tracing is disabled
+    """
+
+    recording = False
+
+    def set(self, **fields):
+        pass
+
+    def add(self, field, amount):
+        pass
+
+    def append(self, field, x):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+null_span = NullSpan()
+
+class Tracer(object):
+    """
+    Streams finished spans to a file
+
+    format: "jsonl" for one JSON object per line, or "chrome" for a trace_event array
+    """
+
+    def __init__(self, path, format="jsonl"):
+        if format not in ("jsonl", "chrome"):
+            raise ValueError("unknown trace format {}".format(format))
+        self.path = path
+        self.format = format
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.origin = time.time()
+        self.file = open(path, "w")
+        self.written = 0
+        if format == "chrome":
+            self.file.write("[\n")
+
+    def record(self, span):
+        result = {
+            "id": span.id,
+            "parent": None if span.parent is None else span.parent.id,
+            "depth": span.depth,
+            "name": span.name,
+            "start": span.start - self.origin,
+            "duration": span.duration,
+            "thread": span.thread,
+        }
+        result.update(span.fields)
+        return result
+
+    def chrome_event(self, span):
+        args = dict(span.fields, id=span.id, depth=span.depth)
+        args["parent"] = None if span.parent is None else span.parent.id
+        return {
+            "name": span.name,
+            "cat": "alba",
+            "ph": "X",
+            "ts": (span.start - self.origin) * 1e6,
+            "dur": span.duration * 1e6,
+            "pid": 0,
+            "tid": span.thread,
+            "args": args,
+        }
+
+    def write(self, span):
+        event = self.record(span) if self.format == "jsonl" else self.chrome_event(span)
+        line = json.dumps(event, default=str)
+        with self.lock:
+            if self.file is None:
+                return
+            if self.format == "chrome" and self.written:
+                self.file.write(",\n")
+            self.file.write(line)
+            if self.format == "jsonl":
+                self.file.write("\n")
+            self.written += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                if self.format == "chrome":
+                    self.file.write("\n]\n")
+                self.file.close()
+                self.file = None
+
+#----the active tracer
+
+tracer = None
+local = threading.local()
+
+def stack():
+    if not hasattr(local, "stack"):
+        local.stack = []
+    return local.stack
+
+def current_span():
+    spans = stack()
+    return spans[-1] if spans else None
+
+def span(name, **fields):
+    """
+    a context manager that records a span named name, if tracing is enabled
+    """
+    if tracer is None:
+        return null_span
+    return Span(tracer, name, current_span(), fields)
+
+def enable(path, format=None):
+    """
+    starts writing spans to path; the format is inferred from the extension if not given
+    """
+    global tracer
+    disable()
+    if format is None:
+        format = "chrome" if path.endswith(".json") else "jsonl"
+    tracer = Tracer(path, format)
+    return tracer
+
+def disable():
+    global tracer
+    if tracer is not None:
+        tracer.close()
+        tracer = None
+
+atexit.register(disable)
+
+class trace(object):
+    """
+    a context manager that enables tracing for its duration
+    """
+
+    def __init__(self, path, format=None):
+        self.path = path
+        self.format = format
+
+    def __enter__(self):
+        return enable(self.path, self.format)
+
+    def __exit__(self, *exc_info):
+        disable()
+
+def propagate(f):
+    """
+    wraps f so that spans it records on another thread are children of the current span
+    """
+    if tracer is None:
+        return f
+    parent = current_span()
+    if parent is None:
+        return f
+    def resumed(*args):
+        spans = stack()
+        spans.append(parent)
+        try:
+            return f(*args)
+        finally:
+            spans.pop()
+    return resumed
+
+#----analysis
+
+def load(path):
+    """
+    returns the spans recorded in path, in either format, as dicts like those in a JSON lines trace
+    """
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        #a chrome trace may be missing its closing bracket if the process didn't exit cleanly
+        body = text.strip().rstrip("]").rstrip().rstrip(",")
+        events = json.loads(body + "]")
+        spans = []
+        for event in events:
+            span = dict(event["args"])
+            span.update(name=event["name"], start=event["ts"] / 1e6, duration=event["dur"] / 1e6, thread=event["tid"])
+            spans.append(span)
+        return spans
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def hch_levels(spans):
+    """
+    maps the id of each hch span to the number of hch spans above it
+    """
+    by_id = dict((span["id"], span) for span in spans)
+    levels = {}
+    def level(span):
+        if span["id"] not in levels:
+            parent = by_id.get(span["parent"])
+            above = 0 if parent is None else level(parent) + (parent["name"] == "hch")
+            levels[span["id"]] = above
+        return levels[span["id"]]
+    for span in spans:
+        level(span)
+    return dict((span["id"], levels[span["id"]]) for span in spans if span["name"] == "hch")
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(p * len(xs)))] if xs else 0
+
+def report(spans, top=10, out=sys.stdout):
+    hch = [span for span in spans if span["name"] == "hch"]
+    levels = hch_levels(spans)
+    out.write("{} spans, {} of them hch nodes\n\n".format(len(spans), len(hch)))
+    out.write("hottest subtrees (by wall time):\n")
+    out.write("{:>10} {:>8} {:>8} {:>10} {:>6}  {}\n".format("seconds", "spent", "budget", "overseer", "level", "question"))
+    for span in sorted(hch, key=lambda span: -span["duration"])[:top]:
+        out.write("{:>10.4f} {:>8} {:>8} {:>10.4f} {:>6}  {}\n".format(
+            span["duration"], span.get("spent"), span.get("budget"),
+            span.get("overseer_seconds", 0), levels[span["id"]], span.get("question", "")
+        ))
+    out.write("\nbudget spent per level:\n")
+    out.write("{:>6} {:>8} {:>10} {:>10} {:>10} {:>10}\n".format("level", "nodes", "total", "median", "p90", "max"))
+    spent = defaultdict(list)
+    for span in hch:
+        spent[levels[span["id"]]].append(span.get("spent", 0))
+    for level in sorted(spent):
+        xs = spent[level]
+        out.write("{:>6} {:>8} {:>10} {:>10} {:>10} {:>10}\n".format(
+            level, len(xs), sum(xs), percentile(xs, 0.5), percentile(xs, 0.9), max(xs)
+        ))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize an HCH trace")
+    parser.add_argument("path", help="a trace written by tracing.enable")
+    parser.add_argument("--top", type=int, default=10, help="the number of subtrees to show")
+    args = parser.parse_args(argv)
+    report(load(args.path), args.top)
+
+if __name__ == "__main__":
+    main()
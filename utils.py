@@ -1,3 +1,10 @@
+import functools
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import metrics
+import tracing
+
 def areinstances(xs, t):
     return isinstance(xs, tuple) and all(isinstance(x, t) for x in xs)
 
@@ -17,11 +24,233 @@ def unweave(xs):
         result[i%2].append(x)
     return tuple(result[0]), tuple(result[1])
 
+def parallel_map(f, xs, workers):
+    """
+    like map(f, xs), but runs up to workers calls at once on a pool of threads;
+    workers may also be a WorkerPool, to share its threads with other calls
+    """
+    if isinstance(workers, WorkerPool):
+        return workers.map(f, xs)
+    xs = list(xs)
+    if workers <= 1 or len(xs) <= 1:
+        return [f(x) for x in xs]
+    pool = ThreadPool(min(workers, len(xs)))
+    try:
+        return pool.map(tracing.propagate(f), xs)
+    finally:
+        pool.close()
+
+class WorkerPool(object):
+    """
+    Threads shared by nested parallel_maps, so that at most size calls run at once across all of them.
+
+    A call only goes to a pool thread if one is free, and otherwise the thread calling map makes it itself,
+    so a map never waits for threads that are waiting for it, and size - 1 pool threads are enough.
+    The threads are started when first needed, reused by every later map, and stopped when the WorkerPool is collected.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.free = threading.Semaphore(max(size - 1, 0))
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def threads(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.size - 1)
+            return self.pool
+
+    def map(self, f, xs):
+        xs = list(xs)
+        propagated = tracing.propagate(f)
+        def run(x):
+            try:
+                return propagated(x)
+            finally:
+                self.free.release()
+        results = [None] * len(xs)
+        pending = []
+        for i, x in enumerate(xs):
+            #the last call is made on this thread, which would otherwise only be waiting
+            if i < len(xs) - 1 and self.free.acquire(False):
+                pending.append((i, self.threads().apply_async(run, (x,))))
+            else:
+                results[i] = f(x)
+        for i, result in pending:
+            results[i] = result.get()
+        return results
+
+    def __del__(self):
+        if self.pool is not None:
+            self.pool.close()
+
+def lru_cache(maxsize):
+    """
+    memoizes a function of hashable arguments, remembering the maxsize most recently used results;
+    the undecorated function is available as __wrapped__
+    """
+    def decorator(f):
+        cache = OrderedDict()
+        lock = threading.Lock()
+        @functools.wraps(f)
+        def memoized(*args):
+            with lock:
+                if args in cache:
+                    cache[args] = value = cache.pop(args)
+                    return value
+            value = f(*args)
+            with lock:
+                cache[args] = value
+                if len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return value
+        memoized.__wrapped__ = f
+        return memoized
+    return decorator
+
+class PersistentVector(object):
+    """
+    An immutable sequence that can be extended without copying it.
+
+    Elements are stored in a trie of tuples with 32 children per node, plus a tail of up to 32 elements,
+    so appending costs O(1) amortized, indexing costs O(log n),
+    and a vector shares all but O(log n) of its structure with the vector it was extended from.
+    """
+
+    __slots__ = ("length", "shift", "root", "tail")
+
+    bits = 5
+    width = 1 << bits
+    mask = width - 1
+
+    def __init__(self, xs=()):
+        self.length, self.shift, self.root, self.tail = 0, self.bits, (), ()
+        if xs:
+            extended = self.extend(xs)
+            self.length, self.shift, self.root, self.tail = extended.length, extended.shift, extended.root, extended.tail
+
+    @classmethod
+    def make(cls, length, shift, root, tail):
+        result = cls.__new__(cls)
+        result.length, result.shift, result.root, result.tail = length, shift, root, tail
+        return result
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError("PersistentVector index out of range")
+        tail_start = self.length - len(self.tail)
+        if i >= tail_start:
+            return self.tail[i - tail_start]
+        node = self.root
+        for level in range(self.shift, 0, -self.bits):
+            node = node[(i >> level) & self.mask]
+        return node[i & self.mask]
+
+    def __iter__(self):
+        stack = [(self.root, self.shift)] if self.length > len(self.tail) else []
+        while stack:
+            node, level = stack.pop()
+            if level == 0:
+                for x in node:
+                    yield x
+            else:
+                stack.extend((child, level - self.bits) for child in reversed(node))
+        for x in self.tail:
+            yield x
+
+    def append(self, x):
+        if len(self.tail) < self.width:
+            return self.make(self.length + 1, self.shift, self.root, self.tail + (x,))
+        #the tail is full, so it becomes a leaf of the trie
+        if (self.length >> self.bits) > (1 << self.shift):
+            root = (self.root, self.path(self.shift, self.tail))
+            shift = self.shift + self.bits
+        else:
+            root = self.push_tail(self.shift, self.root, self.tail)
+            shift = self.shift
+        return self.make(self.length + 1, shift, root, (x,))
+
+    def extend(self, xs):
+        result = self
+        for x in xs:
+            result = result.append(x)
+        return result
+
+    def path(self, level, node):
+        """
+        a branch of the trie that leads down to node, starting from the given level
+        """
+        for _ in range(0, level, self.bits):
+            node = (node,)
+        return node
+
+    def push_tail(self, level, parent, tail):
+        """
+        a copy of parent with tail inserted as the leaf after the last one
+        """
+        i = ((self.length - 1) >> level) & self.mask
+        if level == self.bits:
+            child = tail
+        elif i < len(parent):
+            child = self.push_tail(level - self.bits, parent[i], tail)
+        else:
+            child = self.path(level - self.bits, tail)
+        return parent[:i] + (child,) + parent[i+1:]
+
 def clear_screen():
     print("\x1b[2J\x1b[H")
 
-def elicit_input(observations, actions):
-    clear_screen()
+class Transcript(object):
+    """
+    The history last shown to an overseer, so that the next one can be shown as a continuation of it
+    """
+
+    def __init__(self):
+        self.observations = ()
+        self.actions = ()
+
+    def update(self, observations, actions):
+        """
+        returns (continued, observations, actions);
+        if continued, the history extends the one shown last, and observations and actions are what it adds
+        """
+        observations, actions = tuple(observations), tuple(actions)
+        n, m = len(self.observations), len(self.actions)
+        continued = (
+            n > 0 and len(actions) > m and
+            observations[:n] == self.observations and actions[:m] == self.actions
+        )
+        self.observations, self.actions = observations, actions
+        if continued:
+            return True, observations[n:], actions[m:]
+        return False, observations, actions
+
+def show_history(continued, observations, actions):
+    """
+    prints a history from the start, or if continued prints only what it adds to the one printed last;
+    the first action it adds was typed at the last prompt, so it is already on screen
+    """
+    if continued:
+        actions = actions[1:]
+    else:
+        clear_screen()
     lines = interleave(observations, [">>> {}".format(action) for action in actions])
-    print("\n\n".join(lines))
-    return raw_input("\n>>> ")
+    print(("\n" if continued else "") + "\n\n".join(lines))
+
+shown = Transcript()
+
+def elicit_input(observations, actions, transcript=None):
+    """
+    asks the user at the terminal what to do next;
+    if the history continues the one they were shown last, only the new part is printed
+    """
+    metrics.increment("overseer.queries")
+    show_history(*(shown if transcript is None else transcript).update(observations, actions))
+    with metrics.timed("overseer.elicit_input"):
+        return raw_input("\n>>> ")
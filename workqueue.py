@@ -0,0 +1,342 @@
+import argparse
+import itertools
+import json
+import six
+import threading
+import time
+from collections import defaultdict, deque
+from functools import partial
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import Request, urlopen
+import metrics
+from agent import StatelessAgent
+from utils import Transcript, elicit_input
+
+"""
+A work queue that lets many overseers, human or scripted, answer an agent's queries at once.
+
+overseer(queue) is an agent that can stand in for Human: each time it acts,
+it puts its history on the queue and waits for a worker to answer it.
+Queries from different threads (e.g. HCH(overseer(queue), workers=8)) wait in the queue together,
+and each worker takes the oldest one that nobody is answering.
+
+A queue can be shared over HTTP on localhost:
+
+    queue = WorkQueue()
+    server = QueueServer(queue, port=8765)
+    answer = HCH(overseer(queue), workers=8).act(question)
+
+while each human runs
+
+    python workqueue.py --url http://localhost:8765
+
+Each worker is sent only what a history adds to the last one it was sent,
+so a human working through one conversation sees each new message once, rather than the whole history.
+Each query's wait, work and total latency are recorded in metrics as "overseer.queue.*".
+"""
+
+class Query(object):
+
+    def __init__(self, id, observations, actions):
+        self.id = id
+        self.observations = tuple(observations)
+        self.actions = tuple(actions)
+        self.submitted = time.time()
+        self.taken = None
+        self.worker = None
+        self.answer = None
+        self.done = threading.Event()
+
+class WorkQueue(object):
+    """
+    Queries waiting for an overseer, and the workers answering them
+
+    lease: if a worker takes a query and hasn't answered it after this many seconds,
+    it is offered to the next worker to ask; the first answer wins
+    """
+
+    def __init__(self, lease=None):
+        self.lease = lease
+        self.ids = itertools.count()
+        self.condition = threading.Condition()
+        self.pending = deque()
+        self.queries = {}
+        #worker -> (id of the last query it was sent, the history it was sent)
+        self.transcripts = {}
+        self.answered = defaultdict(int)
+        self.work_seconds = defaultdict(float)
+
+    def ask(self, observations, actions):
+        """
+        blocks until a worker answers, and returns its answer
+        """
+        metrics.increment("overseer.queries")
+        query = self.submit(observations, actions)
+        query.done.wait()
+        return query.answer
+
+    def submit(self, observations, actions):
+        with self.condition:
+            query = Query(next(self.ids), observations, actions)
+            self.queries[query.id] = query
+            self.pending.append(query)
+            self.condition.notify()
+        return query
+
+    def next_query(self):
+        while self.pending:
+            query = self.pending.popleft()
+            if not query.done.is_set():
+                return query
+        if self.lease is not None:
+            now = time.time()
+            for query in self.queries.values():
+                if query.taken is not None and now - query.taken > self.lease:
+                    return query
+        return None
+
+    def take(self, worker, timeout=None, last=None):
+        """
+        returns the next query for worker as a dict, or None if there is none within timeout seconds
+
+        last: the id of the last query this worker received;
+        if it matches, the dict holds only what the query's history adds to that one's
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            query = self.next_query()
+            while query is None:
+                remaining = self.lease if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+                query = self.next_query()
+            query.taken = time.time()
+            query.worker = worker
+            previous, transcript = self.transcripts.get(worker, (None, None))
+            if transcript is None or last is None or previous != last:
+                transcript = Transcript()
+            self.transcripts[worker] = (query.id, transcript)
+            continued, observations, actions = transcript.update(query.observations, query.actions)
+        metrics.observe("overseer.queue.wait", query.taken - query.submitted)
+        return {"id": query.id, "continued": continued, "observations": observations, "actions": actions}
+
+    def answer(self, worker, id, action):
+        """
+        answers the query id on behalf of worker; returns False if it was already answered
+        """
+        with self.condition:
+            query = self.queries.pop(id, None)
+            if query is None:
+                return False
+            now = time.time()
+            self.answered[worker] += 1
+            self.work_seconds[worker] += now - query.taken
+        query.answer = action
+        query.done.set()
+        metrics.observe("overseer.queue.work", now - query.taken)
+        metrics.observe("overseer.queue.latency", now - query.submitted)
+        return True
+
+    def stats(self):
+        with self.condition:
+            return {
+                "pending": len(self.queries),
+                "workers": dict(
+                    (worker, {"answered": n, "mean_seconds": self.work_seconds[worker] / n})
+                    for worker, n in self.answered.items()
+                ),
+            }
+
+def overseer(queue):
+    """
+    an agent whose actions are chosen by whichever worker takes them from queue
+    """
+    return StatelessAgent(queue.ask)
+
+#----serving a queue over HTTP
+
+def from_json(data):
+    """
+    parses JSON from bytes; on python 2, strings are returned as UTF-8 str rather than unicode,
+    like the strings that agents pass around, which are hashed as bytes (see memoizer.md5)
+    """
+    return native(json.loads(data.decode("utf-8")))
+
+def native(x):
+    if six.PY3:
+        return x
+    if isinstance(x, six.text_type):
+        return x.encode("utf-8")
+    if isinstance(x, list):
+        return [native(y) for y in x]
+    if isinstance(x, dict):
+        return dict((native(k), native(v)) for k, v in x.items())
+    return x
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.reply(200, self.server.queue.stats())
+        else:
+            self.reply(404, {"error": "unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = from_json(self.rfile.read(length))
+        queue = self.server.queue
+        if self.path == "/take":
+            task = queue.take(request["worker"], request.get("timeout"), request.get("last"))
+            if task is None:
+                self.reply(204)
+            else:
+                self.reply(200, task)
+        elif self.path == "/answer":
+            if queue.answer(request["worker"], request["id"], request["action"]):
+                self.reply(200, {})
+            else:
+                self.reply(409, {"error": "query {} was already answered".format(request["id"])})
+        else:
+            self.reply(404, {"error": "unknown path {}".format(self.path)})
+
+    def reply(self, status, body=None):
+        self.send_response(status)
+        if body is None:
+            self.end_headers()
+            return
+        data = json.dumps(body).encode("utf-8")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class HTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class QueueServer(object):
+    """
+    serves queue over HTTP on localhost, from a background thread
+
+    port: 0 picks a free port; url says which
+    """
+
+    def __init__(self, queue, port=0, host="localhost"):
+        self.server = HTTPServer((host, port), Handler)
+        self.server.queue = queue
+        self.url = "http://{}:{}".format(host, self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class RemoteQueue(object):
+    """
+    the worker's side of a WorkQueue served by a QueueServer at url
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def post(self, path, body, timeout=None):
+        request = Request(self.url + path, json.dumps(body).encode("utf-8"), {"Content-Type": "application/json"})
+        response = urlopen(request, timeout=timeout)
+        data = response.read()
+        return response.getcode(), from_json(data) if data else None
+
+    def take(self, worker, timeout=None, last=None):
+        #allow the server a little longer than the long poll before giving up on it
+        status, task = self.post(
+            "/take", {"worker": worker, "timeout": timeout, "last": last},
+            None if timeout is None else timeout + 10
+        )
+        return task if status == 200 else None
+
+    def answer(self, worker, id, action):
+        try:
+            self.post("/answer", {"worker": worker, "id": id, "action": action})
+        except HTTPError as e:
+            if e.code == 409:
+                return False
+            raise
+        return True
+
+#----workers
+
+class Worker(object):
+    """
+    Takes queries from queue and answers them with respond(observations, actions)
+
+    queue: a WorkQueue, or a RemoteQueue to work on one served elsewhere
+    """
+
+    worker_ids = itertools.count()
+
+    def __init__(self, queue, respond, name=None):
+        self.queue = queue
+        self.respond = respond
+        self.name = "worker {}".format(next(Worker.worker_ids)) if name is None else name
+        self.last = None
+        self.observations = ()
+        self.actions = ()
+
+    def step(self, timeout=None):
+        """
+        answers one query; returns False if none arrived within timeout seconds
+        """
+        task = self.queue.take(self.name, timeout, self.last)
+        if task is None:
+            return False
+        self.last = task["id"]
+        if task["continued"]:
+            self.observations += tuple(task["observations"])
+            self.actions += tuple(task["actions"])
+        else:
+            self.observations, self.actions = tuple(task["observations"]), tuple(task["actions"])
+        self.queue.answer(self.name, task["id"], self.respond(self.observations, self.actions))
+        return True
+
+    def run(self, stop=None, poll=1.0):
+        """
+        answers queries until stop (a threading.Event) is set
+        """
+        while stop is None or not stop.is_set():
+            self.step(poll)
+
+    def start(self, stop, poll=1.0):
+        """
+        runs this worker on a daemon thread until stop is set
+        """
+        thread = threading.Thread(target=self.run, args=(stop, poll))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+def scripted_workers(queue, policy, n, stop):
+    """
+    starts n workers following policy(observations, actions), until stop is set
+    """
+    return [Worker(queue, policy, "scripted {}".format(i)).start(stop, poll=0.1) for i in range(n)]
+
+def human_worker(queue, name=None):
+    """
+    a worker that asks the user at the terminal, showing each history as a continuation of the last where possible
+    """
+    return Worker(queue, partial(elicit_input, transcript=Transcript()), name)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Answer queries from a work queue at the terminal")
+    parser.add_argument("--url", default="http://localhost:8765", help="where the QueueServer is")
+    parser.add_argument("--name", help="the name to record your answers under")
+    args = parser.parse_args(argv)
+    human_worker(RemoteQueue(args.url), args.name).run()
+
+if __name__ == "__main__":
+    main()